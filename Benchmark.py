@@ -0,0 +1,266 @@
+'''
+Offline parser benchmark
+Generates deterministic PriceFull files for each platform dialect and measures
+parsing speed and memory for every parsing backend and filter configuration
+    python Benchmark.py --sizes 1000 100000 --densities 0.01 0.1
+'''
+import os
+import gzip
+import time
+import random
+import argparse
+import resource
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+from ItemMatcher import ItemMatcher
+from Store import parseStoreFile
+from XmlBackend import BACKENDS
+
+CHAIN_ID = 7290000000001
+TARGET_MANU = 'ביכורי השקמה'
+OTHER_MANUS = ['תנובה', 'שטראוס', 'אסם', 'לא ידוע']
+CATEGORY_R = r'^777\d{3}$'
+ITEM_CODES = [7290000000100 + i for i in range(12)]
+
+# header tags, container and item tags, and item fields in file order per dialect
+DIALECTS = {
+        'cerberus': {
+            'root': 'Root',
+            'header': ('ChainId', 'SubChainId', 'StoreId', 'BikoretNo'),
+            'container': 'Items',
+            'item': 'Item',
+            'fields': ('PriceUpdateDate', 'ItemCode', 'ItemType', 'ItemName', 'ManufacturerName',
+                'ManufactureCountry', 'ManufacturerItemDescription', 'UnitQty', 'Quantity',
+                'bIsWeighted', 'UnitOfMeasure', 'QtyInPackage', 'ItemPrice', 'UnitOfMeasurePrice',
+                'AllowDiscount', 'ItemStatus'),
+            'encoding': 'utf-8',
+        },
+        'matrix': {
+            'root': 'Prices',
+            'header': ('ChainID', 'SubChainID', 'StoreID', 'BikoretNo'),
+            'container': 'Products',
+            'item': 'Product',
+            'fields': ('PriceUpdateDate', 'ItemCode', 'ItemType', 'ItemName', 'ManufactureName',
+                'ManufactureCountry', 'ManufactureItemDescription', 'UnitQty', 'Quantity',
+                'bIsWeighted', 'QtyInPackage', 'ItemPrice', 'UnitOfMeasurePrice', 'AllowDiscount',
+                'itemStatus'),
+            'encoding': 'utf-8',
+        },
+        'bina': {
+            'root': 'Root',
+            'header': ('ChainId', 'SubChainId', 'StoreId', 'BikoretNo'),
+            'container': 'Items',
+            'item': 'Item',
+            'fields': ('PriceUpdateDate', 'ItemCode', 'ItemType', 'ItemNm', 'ManufacturerName',
+                'ManufactureCountry', 'ManufacturerItemDescription', 'UnitQty', 'Quantity',
+                'UnitOfMeasure', 'bIsWeighted', 'QtyInPackage', 'ItemPrice', 'UnitOfMeasurePrice',
+                'AllowDiscount', 'ItemStatus'),
+            'encoding': 'utf-8',
+        },
+        'mega': {
+            'root': 'root',
+            'header': ('ChainId', 'SubChainId', 'StoreId', 'BikoretNo'),
+            'container': 'Items',
+            'item': 'Item',
+            'fields': ('PriceUpdateDate', 'ItemCode', 'ItemType', 'ItemName', 'ManufacturerName',
+                'ManufactureCountry', 'ManufacturerItemDescription', 'UnitQty', 'Quantity',
+                'UnitOfMeasure', 'bIsWeighted', 'QtyInPackage', 'ItemPrice', 'UnitOfMeasurePrice',
+                'AllowDiscount', 'ItemStatus'),
+            # UTF-16 with BOM while the header claims UTF-8, exercises encoding sniffing
+            'encoding': 'utf-16',
+        },
+        'shufersal': {
+            'root': 'root',
+            'header': ('ChainId', 'SubChainId', 'StoreId', 'BikoretNo'),
+            'container': 'Items',
+            'item': 'Item',
+            'fields': ('PriceUpdateDate', 'ItemCode', 'ItemType', 'ItemName', 'ManufacturerName',
+                'ManufactureCountry', 'ManufacturerItemDescription', 'UnitQty', 'Quantity',
+                'UnitOfMeasure', 'bIsWeighted', 'QtyInPackage', 'ItemPrice', 'UnitOfMeasurePrice',
+                'AllowDiscount', 'ItemStatus'),
+            'encoding': 'utf-8',
+        },
+}
+
+FILTERS = {
+        'manu': {'manu': TARGET_MANU},
+        'codes': {'itemCodes': ITEM_CODES},
+        'category': {'codeCategoryR': CATEGORY_R},
+        'all': {'manu': TARGET_MANU, 'itemCodes': ITEM_CODES, 'codeCategoryR': CATEGORY_R},
+}
+
+def _itemValues(rng, matching, code):
+    manu = TARGET_MANU if matching else rng.choice(OTHER_MANUS)
+    price = f"{rng.randint(100, 9999) / 100:.2f}"
+    return {
+            'PriceUpdateDate': f"2023-07-0{rng.randint(1, 3)} 0{rng.randint(0, 9)}:00",
+            'ItemCode': str(code),
+            'ItemType': '1',
+            'ItemName': f"מוצר {code}",
+            'ItemNm': f"מוצר {code}",
+            'ManufacturerName': manu,
+            'ManufactureName': manu,
+            'ManufactureCountry': 'IL',
+            'ManufacturerItemDescription': f"תיאור {code}",
+            'ManufactureItemDescription': f"תיאור {code}",
+            'UnitQty': 'קילוגרמים',
+            'Quantity': '1.00',
+            'bIsWeighted': '1',
+            'UnitOfMeasure': '1 ק"ג',
+            'QtyInPackage': '0',
+            'ItemPrice': price,
+            'UnitOfMeasurePrice': price,
+            'AllowDiscount': '1',
+            'ItemStatus': '1',
+            'itemStatus': '1',
+    }
+
+def generate(dirname, dialect, n, density, seed=0):
+    '''
+        Generate a deterministic PriceFull file
+        ---------------------
+        Parameters:
+            dirname - where to write the file
+            dialect - key of DIALECTS
+            n - number of items
+            density - fraction of items matching the manufacturer and code category filters
+            seed - random seed
+        =====================
+        Return:
+            1. path to the gzip file
+            2. size of the uncompressed xml in bytes
+        Side effects:
+            writes the file, reuses it if it exists
+    '''
+    d = DIALECTS[dialect]
+    fn = f"{dirname}/PriceFull{CHAIN_ID}-{dialect}-{n}-{int(density * 1000):04d}-{seed}-202307030400.gz"
+    if os.path.exists(fn):
+        with gzip.open(fn, 'rb') as f:
+            return fn, sum(len(chunk) for chunk in iter(lambda: f.read(1 << 20), b''))
+
+    rng = random.Random(seed)
+    codePositions = set(rng.sample(range(n), min(n, len(ITEM_CODES))))
+    listedCodes = iter(ITEM_CODES)
+    headerValues = [str(CHAIN_ID), '1', '1', '123']
+    size = 0
+    with gzip.open(fn, 'wb', compresslevel=6) as f:
+        def write(text):
+            nonlocal size
+            data = text.encode(d['encoding'])
+            # a single BOM at the start of the file
+            if d['encoding'] == 'utf-16' and size > 0:
+                data = data[2:]
+            size = size + len(data)
+            f.write(data)
+
+        header = ''.join(f"<{tag}>{value}</{tag}>" for tag, value in zip(d['header'], headerValues))
+        write(f'<?xml version="1.0" encoding="utf-8"?>\n<{d["root"]}>{header}<{d["container"]} Count="{n}">')
+        for i in range(n):
+            matching = rng.random() < density
+            if i in codePositions:
+                code = next(listedCodes)
+            elif matching:
+                code = 777000 + rng.randint(0, 999)
+            else:
+                code = 7290000000000 + rng.randint(1000, 9999999)
+            values = _itemValues(rng, matching, code)
+            fields = ''.join(f"<{tag}>{values[tag]}</{tag}>" for tag in d['fields'])
+            write(f"<{d['item']}>{fields}</{d['item']}>")
+        write(f"</{d['container']}></{d['root']}>")
+    return fn, size
+
+def runCase(fn, filterName, backendName):
+    '''
+        Parse one file, runs in a fresh process so memory readings are per case
+        ---------------------
+        Parameters:
+            fn - file name
+            filterName - key of FILTERS
+            backendName - key of XmlBackend.BACKENDS
+        =====================
+        Return:
+            dict of matched items, seconds, peak traced memory (python allocations) and max rss
+    '''
+    logger.remove()
+    matcher = ItemMatcher(**FILTERS[filterName])
+    start = time.perf_counter()
+    items = parseStoreFile(fn, matcher, CHAIN_ID, backendName)
+    seconds = time.perf_counter() - start
+    # tracing slows parsing down, memory is measured on a second run
+    tracemalloc.start()
+    parseStoreFile(fn, matcher, CHAIN_ID, backendName)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+            'matched': len(items),
+            'seconds': seconds,
+            'peakTracedKB': peak // 1024,
+            'maxRssKB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def runBenchmark(dirname='./bench', dialects=None, sizes=(1000,), densities=(0.01,), backends=None, filters=None, seed=0):
+    '''
+        Run every combination of dialect, size, density, backend and filter
+        ---------------------
+        Parameters:
+            dirname - where generated files are kept
+            dialects, sizes, densities, backends, filters - what to run, all known if None
+            seed - random seed of the generated files
+        =====================
+        Return:
+            list of result dicts
+        Side effects:
+            generates files in dirname
+    '''
+    if dialects is None:
+        dialects = list(DIALECTS)
+    if backends is None:
+        backends = list(BACKENDS)
+    if filters is None:
+        filters = list(FILTERS)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    results = []
+    spawn = multiprocessing.get_context('spawn')
+    for dialect in dialects:
+        for n in sizes:
+            for density in densities:
+                fn, size = generate(dirname, dialect, n, density, seed)
+                for backendName in backends:
+                    for filterName in filters:
+                        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                            res = pool.submit(runCase, fn, filterName, backendName).result()
+                        res.update({
+                            'dialect': dialect,
+                            'items': n,
+                            'density': density,
+                            'backend': backendName,
+                            'filter': filterName,
+                            'itemsPerSec': n / res['seconds'],
+                            'MBPerSec': size / res['seconds'] / 1e6,
+                        })
+                        results.append(res)
+                        printResult(res)
+    return results
+
+def printResult(res):
+    print(f"{res['dialect']:>10} {res['items']:>8} {res['density']:>6} {res['backend']:>7} {res['filter']:>9} "
+            f"matched {res['matched']:>7} {res['itemsPerSec']:>10.0f} items/s {res['MBPerSec']:>7.1f} MB/s "
+            f"peak {res['peakTracedKB']:>7} KB traced {res['maxRssKB']:>7} KB rss")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline PriceFull parser benchmark")
+    parser.add_argument('--dir', default='./bench', help="where generated files are kept")
+    parser.add_argument('--dialects', nargs='+', choices=list(DIALECTS), default=None)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--densities', nargs='+', type=float, default=[0.01, 0.1])
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=None)
+    parser.add_argument('--filters', nargs='+', choices=list(FILTERS), default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    runBenchmark(args.dir, args.dialects, args.sizes, args.densities, args.backends, args.filters, args.seed)
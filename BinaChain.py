@@ -1,16 +1,18 @@
 # TODO downloading twice file for same date, fix?
 import os
-import gzip
 import datetime
 import re
 import json
-import xml.etree.ElementTree as ET
-
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException
 from Chain import Chain
+from Http import getSession, send, PRIOR_CONCURRENCY
 
+# priors requested ahead of their downloads, sent by PRIOR_CONCURRENCY threads so the
+# connection pool of the host holds the priors and the downloads together
+PRIOR_WINDOW = 8
 class BinaChain(Chain):
     '''
     The basic functions each Chain should implement
@@ -18,10 +20,12 @@ class BinaChain(Chain):
     def __init__(self, db, url, name, chainId, manu=None, itemCodes=None, codeCategoryR=None):
         username = None
         password = None
+        self._priorPool = ThreadPoolExecutor(max_workers=PRIOR_CONCURRENCY, thread_name_prefix=f'prior-{name}')
+        self._priorWindow = threading.BoundedSemaphore(PRIOR_WINDOW)
         super().__init__(db, url, username, password, name, chainId, manu=manu, itemCodes=itemCodes, codeCategoryR=codeCategoryR)
 
     def login(self):
-        return requests.Session()
+        return getSession(self.url, self.username)
 
     def download_page(self, page, updateDate=None, firstOfLast=None):
         '''
@@ -46,7 +50,7 @@ class BinaChain(Chain):
                 'WFileType': 4
         }
         url = f'{self.url}/MainIO_Hok.aspx'
-        r = self.session.get(url, params=params)
+        r = self._request('GET', url, params=params)
         filesJson = r.json()
         links = []
 
@@ -64,6 +68,8 @@ class BinaChain(Chain):
             if fileDate < updateDate:
                 self._log(f"Stop paging, reached fileDate: {fileDate}")
                 break
+            if not self._isSelected(fn):
+                continue
 
             link = f'{self.url}/Download/{fn}'
             prior = f'{self.url}/Download.aspx?FileNm={fn}'
@@ -88,7 +94,7 @@ class BinaChain(Chain):
                 'WFileType': 1
         }
         url = f'{self.url}/MainIO_Hok.aspx'
-        r = self.session.get(url, params=params)
+        r = self._request('GET', url, params=params)
         filesJson = r.json()
         fileJson = filesJson[0]
 
@@ -111,11 +117,9 @@ class BinaChain(Chain):
                 list of Item objects
         '''
         self._log(f"Obtaining stores from {fn}")
-        with gzip.open(fn, 'rt') as f:
-            data = f.read()
-            context = ET.fromstring(data)
+        context = self.backend.parse(fn)
 
-        chainId = int(context.find('.//ChainId').text)
+        chainId = int(self.backend.find(context, './/ChainId').text)
         if self.chainId is not None and chainId != self.chainId:
             # chainId in file should be like setup
             logger.error(f"Chain {self.chainId}: file with wrong chain Id {chainId} supplied {fn}")
@@ -128,7 +132,7 @@ class BinaChain(Chain):
         subchains = self._getSubchains(self.chainId)
         stores = self._getStores(self.chainId)
 
-        subchainsElem = context.find('.//SubChains')
+        subchainsElem = self.backend.find(context, './/SubChains')
         storesIns = {}
         storeLinks = {}
         for sc in subchainsElem:
@@ -153,6 +157,32 @@ class BinaChain(Chain):
 
         self._insertStores(storesIns, storeLinks)
 
+    # ========== PRIVATE ==========
+    def _submitDownload(self, item):
+        '''
+            Submit a listed file to the downloader, its prior is requested ahead
+            Up to PRIOR_WINDOW priors are in flight before their downloads complete,
+            so downloads don't wait a round trip for their prior
+            ---------------------
+            Parameters:
+               item - dict of link, name and prior
+            Uses:
+            =====================
+            Return:
+                Future of _download_gz
+            Side effects:
+                blocks while the window is full
+        '''
+        filename = f"{self.dirname}/{item['name']}.gz"
+        if 'prior' not in item or (self.manifest.isPresent(item['name'], filename) and not self._revalidates(item['name'])):
+            return super()._submitDownload(item)
+        self._priorWindow.acquire()
+        self._log(f"Accessing refreshing point (prior) at {item['prior']}")
+        priorSent = self._priorPool.submit(send, self.session, 'GET', item['prior'], client=self, verify=False)
+        future = self.downloader.submit(item['link'], self._download_gz, item['name'], item['link'], prior=item['prior'], priorSent=priorSent)
+        future.add_done_callback(lambda f: self._priorWindow.release())
+        return future
+
 class KingStore(BinaChain):
     def __init__(self, db):
         url = "https://www.kingstore.co.il/Food_Law"
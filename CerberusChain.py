@@ -1,29 +1,65 @@
 import os
 import re
-import gzip
+import json
+import time
+import datetime
+import threading
 from io import BytesIO
-import requests
 
-import xml.etree.ElementTree as ET
 from loguru import logger
 
-from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException
+from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException, SessionExpiredException
 from Chain import Chain
+from Http import getSession
 
 csrfTokenR = re.compile('<meta name="csrftoken" content="(.*)"')
+# regular csrf token of each logged in user, by site and user name
+csrfTokens = {}
+# logins done of each user, a thread finding the session expired after another thread
+# logged in again doesn't log in twice
+loginCounts = {}
+loginLock = threading.RLock()
+# cached listing of PriceFull and Stores files, in the chain data folder
+LISTING_FILE = 'listing.json'
+LISTING_PAGE = 1000
+# seconds a fetched listing is used before asking the site for newer files
+LISTING_TTL = 600
+# days of files kept in the cached listing
+LISTING_KEEP_DAYS = 30
+CERBERUS_TIME = '%Y-%m-%dT%H:%M:%SZ'
+# datatables server side sorting, newest first
+LISTING_SORT = {
+        'iColumns': 4,
+        'mDataProp_0': 'fname',
+        'mDataProp_1': 'type',
+        'mDataProp_2': 'size',
+        'mDataProp_3': 'ftime',
+        'iSortingCols': 1,
+        'iSortCol_0': 3,
+        'sSortDir_0': 'desc',
+}
+listingR = re.compile('^(PriceFull|Stores)')
 class CerberusChain(Chain):
     '''
     The basic functions each Chain should implement
     '''
     def __init__(self, db, username, password, name, chainId, manu=None, itemCodes=None, codeCategoryR=None):
         url = "https://url.retail.publishedprices.co.il"
+        # loaded on first use, updateChain may need it while constructing
+        self.listing = None
+        self._listedAt = None
+        # the download thread lists files while the scan may update the stores
+        self._catalogLock = threading.Lock()
         super().__init__(db, url, username, password, name, chainId, manu=manu, itemCodes=itemCodes, codeCategoryR=codeCategoryR)
 
-    def login(self):
+    def login(self, refresh=False):
         '''
         Login to site if needed
+        A login is kept for the lifetime of its session, chain objects of the same
+        user reuse it, it is refreshed only when the session expired
         ---------------------
         Parameters:
+            refresh - login again, the session expired
         Uses:
         =====================
         Return:
@@ -31,19 +67,30 @@ class CerberusChain(Chain):
         Side effects:
             downloads files to dirname
         '''
-        session = requests.Session()
-        loginCsrfToken = self._getCSRF(session=session, typ="login")
-
-        loginUrl = f"{self.url}/login/user"
-        r = session.post(loginUrl,
-                data={
-                    'username': self.username,
-                    'password': self.password,
-                    'csrftoken': loginCsrfToken
-                },
-            verify=False)
-        self._log(f"Post to {self.username}:{self.password}@{loginUrl} with response code {r.status_code}")
-        return session
+        # chains of the platform share connections, each login keeps its cookies
+        session = getSession(self.url, self.username)
+        key = (self.url, self.username)
+        with loginLock:
+            if key in csrfTokens and not refresh:
+                self._log(f"Reusing login of {self.username}")
+                return session
+            session.cookies.clear()
+            csrfTokens.pop(key, None)
+            loginCsrfToken = self._getCSRF(session=session, typ="login")
+
+            loginUrl = f"{self.url}/login/user"
+            r = self._request('POST', loginUrl, session=session,
+                    data={
+                        'username': self.username,
+                        'password': self.password,
+                        'csrftoken': loginCsrfToken
+                    },
+                verify=False)
+            self._log(f"Post to {self.username}:{self.password}@{loginUrl} with response code {r.status_code}")
+            # logged in, the regular token is fetched when first needed
+            csrfTokens[key] = None
+            loginCounts[key] = loginCounts.get(key, 0) + 1
+            return session
 
     def download_page(self, page=1, updateDate=None, firstOfLast=None):
         '''
@@ -61,16 +108,9 @@ class CerberusChain(Chain):
         '''
         if updateDate is None:
             updateDate = self._getLatestDate()
-        csrfToken = self._getCSRF()
-        url = f"{self.url}/file/json/dir"
-        data = self.session.post(url, data={
-            'csrftoken':csrfToken,
-            'sSearch': 'PriceFull',
-            'iDisplayLength': 100000,
-            }, verify=False)
-        json_data = data.json()
-        allFilesData = {f['DT_RowId']: self._todatetime(f['time'], typ='cerberus') for f in json_data['aaData']}
-        filesData = [{ 'link': f'{self.url}/file/d/{rid}', 'name': rid[:-3]} for rid, date in allFilesData.items() if date > updateDate]
+        # listing times sort as strings, no need to convert every row
+        updateTime = updateDate.strftime(CERBERUS_TIME)
+        filesData = [{ 'link': f'{self.url}/file/d/{rid}', 'name': rid[:-3]} for rid, t in self._catalog().items() if self.priceR.match(rid) and t > updateTime and self._isSelected(rid)]
         return filesData, False
 
     def getStoreFile(self, updating):
@@ -85,15 +125,14 @@ class CerberusChain(Chain):
             Side effects:
                 Download file with stores data
         '''
-        csrfToken = self._getCSRF()
-        url = f"{self.url}/file/json/dir"
-        data = self.session.post(url, data={
-            'csrftoken':csrfToken,
-            'sSearch': 'Stores',
-            'iDisplayLength': 100000,
-            }, verify=False)
-        json_data = data.json()
-        storeFiles = { f['DT_RowId']: self._todatetime(self.dateR.search(f['DT_RowId']).group(1)) for f in json_data['aaData'] if self.storeR.match(f['DT_RowId'])}
+        storeFiles = { rid: self._todatetime(self.dateR.search(rid).group(1)) for rid in self._catalog() if self.storeR.match(rid)}
+        if len(storeFiles) == 0:
+            # no stores file within the kept days of the listing, search the whole site
+            self._log("No stores file in the listing, searching the site")
+            rows = self._listDir('Stores')['aaData']
+            storeFiles = { row['DT_RowId']: self._todatetime(self.dateR.search(row['DT_RowId']).group(1)) for row in rows if self.storeR.match(row['DT_RowId'])}
+        if len(storeFiles) == 0:
+            raise NoSuchStoreException
         storeFile = max(storeFiles, key=storeFiles.get)
         storeFileName = storeFile # xml
         link = f'{self.url}/file/d/{storeFile}'
@@ -113,11 +152,9 @@ class CerberusChain(Chain):
                 list of Item objects
         '''
         self._log(f"Obtaining stores from {fn}")
-        with gzip.open(fn, 'rt', encoding='utf-16') as f:
-            data = f.read()
-            context = ET.fromstring(data)
+        context = self.backend.parse(fn)
 
-        chainId = int(context.find('.//ChainId').text)
+        chainId = int(self.backend.find(context, './/ChainId').text)
         if self.chainId is not None and chainId != self.chainId:
             # chainId in file should be like setup
             logger.error(f"Chain {self.chainId}: file with wrong chain Id {chainId} supplied {fn}")
@@ -130,7 +167,7 @@ class CerberusChain(Chain):
         subchains = self._getSubchains(self.chainId)
         stores = self._getStores(self.chainId)
 
-        subchainsElem = context.find('.//SubChains')
+        subchainsElem = self.backend.find(context, './/SubChains')
         storesIns = {}
         storeLinks = {}
         for sc in subchainsElem:
@@ -156,9 +193,190 @@ class CerberusChain(Chain):
         self._insertStores(storesIns, storeLinks)
 
     # ========== PRIVATE ==========
-    def _getCSRF(self, session=None, typ="regular"):
+    def _catalog(self):
+        '''
+            PriceFull and Stores files on the site
+            The listing is kept in the chain folder, only files newer than the
+            newest known file are requested, sorted and paged by the server
+            ---------------------
+            Parameters:
+            =====================
+            Return:
+                dict of file name to listing time, not changed by later listings
+            Side effects:
+                updates the listing file
+        '''
+        with self._catalogLock:
+            return self._updateCatalog()
+
+    def _updateCatalog(self):
+        if self.listing is None:
+            self.listing = self._loadListing()
+        if self._listedAt is not None and time.monotonic() - self._listedAt < LISTING_TTL:
+            return self.listing['files']
+        newest = self.listing.get('newest')
+        rows = self._listNewest(newest)
+        if rows is None:
+            self._log("Listing is not sorted by the site, fetching the full listing")
+            rows = self._listDir('PriceFull')['aaData'] + self._listDir('Stores')['aaData']
+            self.listing['files'] = {}
+        # a new dict, catalogs returned before are still iterated
+        files = dict(self.listing['files'])
+        for row in rows:
+            if listingR.match(row['DT_RowId']):
+                files[row['DT_RowId']] = row['time']
+            if newest is None or row['time'] > newest:
+                newest = row['time']
+        self.listing['newest'] = newest
+        if newest is not None:
+            oldest = (self._todatetime(newest, typ='cerberus') - datetime.timedelta(LISTING_KEEP_DAYS)).strftime(CERBERUS_TIME)
+            files = {rid: t for rid, t in files.items() if t >= oldest}
+        self.listing['files'] = files
+        self._log(f"Listed {len(rows)} new files")
+        self._saveListing()
+        self._listedAt = time.monotonic()
+        return self.listing['files']
+
+    def _listNewest(self, newest):
+        '''
+            Newest files on the site, newest first, paging until reaching newest
+            ---------------------
+            Parameters:
+                newest - listing time of the newest known file, None to list all
+            =====================
+            Return:
+                list of listing rows, None if the site doesn't sort them
+        '''
+        rows = []
+        start = 0
+        while True:
+            page = self._listDir('', iDisplayStart=start, iDisplayLength=LISTING_PAGE, **LISTING_SORT)['aaData']
+            times = [row['time'] for row in page]
+            if times != sorted(times, reverse=True) or (len(rows) > 0 and len(times) > 0 and times[0] > rows[-1]['time']):
+                return None
+            rows.extend(page)
+            if len(page) < LISTING_PAGE or (newest is not None and times[-1] < newest):
+                return rows
+            start = start + len(page)
+
+    def _loadListing(self):
+        path = f'{self.dirname}/{LISTING_FILE}'
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                self._log(f"Listing {path} is corrupt, listing all files")
+        return {'newest': None, 'files': {}}
+
+    def _saveListing(self):
+        path = f'{self.dirname}/{LISTING_FILE}'
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.listing, f, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+    def _listDir(self, search, **params):
+        '''
+            List files on the site
+            A rejected token is refreshed, if it is still rejected the session expired and
+            the chain logs in again
+            ---------------------
+            Parameters:
+                search - file name search term
+                params - more datatables parameters (paging, sorting)
+            =====================
+            Return:
+                json listing
+        '''
+        url = f"{self.url}/file/json/dir"
+        def post():
+            data = {
+                'csrftoken': self._getCSRF(),
+                'sSearch': search,
+                'iDisplayLength': 100000,
+            }
+            data.update(params)
+            return self._request('POST', url, data=data, verify=False)
+        logins = self._loginCount()
+        data = post()
+        if self._authFailed(data):
+            self._log("CSRF token rejected, refreshing it")
+            self._getCSRF(refresh=True)
+            data = post()
+        if self._authFailed(data):
+            self._relogin(logins)
+            data = post()
+        data.raise_for_status()
+        return data.json()
+
+    def _authFailed(self, response):
+        # expired sessions are redirected to the login page
+        return self._loginExpired(response) or 'json' not in response.headers.get('Content-Type', '')
+
+    def _loginExpired(self, response):
+        '''
+            Was a request refused or redirected to the login page, files and listings are never html
+        '''
+        return response.status_code in (401, 403) or response.url.rstrip('/').endswith('/login') \
+                or response.headers.get('Content-Type', '').startswith('text/html')
+
+    def _download_gz(self, fn, link, prior=None, priorSent=None):
+        '''
+            Download a gzip file, logging in again if the session expired
+            ---------------------
+            Parameters:
+               fn - name to save
+               link - where to download from
+            Uses:
+            =====================
+            Return:
+                path to file
+            Side effects:
+                see Chain._download_gz
+        '''
+        logins = self._loginCount()
+        try:
+            return super()._download_gz(fn, link, prior, priorSent)
+        except SessionExpiredException:
+            self._relogin(logins)
+            return super()._download_gz(fn, link, prior)
+
+    def _loginCount(self):
+        return loginCounts.get((self.url, self.username), 0)
+
+    def _relogin(self, logins):
+        '''
+            Login again after the session expired, unless another thread already did
+            ---------------------
+            Parameters:
+                logins - login count when the expired request was sent
+            =====================
+            Return:
+            Side effects:
+                logs in, sets session
+        '''
+        with loginLock:
+            if self._loginCount() == logins:
+                self._log("Session expired, logging in again")
+                self.session = self.login(refresh=True)
+
+    def _getCSRF(self, session=None, typ="regular", refresh=False):
+        '''
+            CSRF token of a page, the regular token is cached for the lifetime of the login
+            ---------------------
+            Parameters:
+                session - session, chain session if None
+                typ - regular or login
+                refresh - fetch the regular token again
+            =====================
+            Return:
+                token, None if the page has none
+        '''
         if session is None:
             session = self.session
+        key = (self.url, self.username)
+        if typ == "regular" and not refresh and csrfTokens.get(key) is not None:
+            return csrfTokens[key]
         url = self.url
         if typ == "regular":
             url = f"{self.url}/file"
@@ -167,9 +385,12 @@ class CerberusChain(Chain):
         else:
             # TODO special exception
             raise Exception
-        csrfPage = session.get(url, verify=False)
-        csrfPageContent = csrfPage.text
-        return csrfTokenR.search(csrfPageContent).group(1)
+        csrfPage = self._request('GET', url, session=session, verify=False)
+        match = csrfTokenR.search(csrfPage.text)
+        token = None if match is None else match.group(1)
+        if typ == "regular":
+            csrfTokens[key] = token
+        return token
 
 ### SubClasses ###
 class RamiLevy(CerberusChain):
@@ -1,28 +1,58 @@
-import time
 import os
-import io
 import re
+import queue
+import shutil
+import tempfile
 import datetime
-from zipfile import ZipFile
+import itertools
+import threading
+import collections
+import multiprocessing
+import zlib
+from zipfile import ZipFile, BadZipFile
 import gzip
+from concurrent.futures import ProcessPoolExecutor
 
-import xml.etree.ElementTree as ET
-
-import requests
 from lxml import etree
 from loguru import logger
 
-from CustomExceptions import WrongChainFileException, WrongStoreFileException, NoStoreException, NoSuchStoreException
-from Store import Store
-
-MAX_SLEEPS = 3
-SLEEP_SECS = 30
+from CustomExceptions import WrongChainFileException, WrongStoreFileException, NoStoreException, NoSuchStoreException, InvalidDownloadException, SessionExpiredException, DownloadsStoppedException
+from Store import Store, parseStoreFile
+from Schema import peekHeader
+from ItemMatcher import ItemMatcher
+from XmlBackend import getBackend, sniffEncoding
+from Profiler import profiler
+from Downloader import downloader, HOST_CONCURRENCY
+from Manifest import Manifest
+from Http import RetryPolicy, request, send, iterContent
+
+# processes parsing price files in scanStores, 0 parses in the main process
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 0))
+# downloaded files waiting to be parsed, new downloads wait when it is full
+PARSE_QUEUE = int(os.environ.get('PARSE_QUEUE', 8))
 GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+# bytes read from a download response at a time
+DOWNLOAD_CHUNK = 64 * 1024
+# compression level for files not published as gzip
+GZIP_LEVEL = 6
 ZIP_MAGIC_NUMBER = b'PK'
+# decompressed bytes checked to tell an xml file from an html page
+PAYLOAD_HEAD = 1024
 class Chain:
     '''
     The basic functions each Chain should implement
     '''
+    # xml parsing backend name (see XmlBackend), None for the default
+    parserBackend = None
+    # re-request downloaded files with conditional requests, catching files republished under
+    # the same name, only files the server sent an ETag or Last-Modified for are re-requested
+    revalidateDownloads = True
+    # stores to track, by store id, subchain id or city (as in the store table), None for all
+    # a store matching any of them is tracked, other stores' files aren't downloaded or parsed
+    trackedStores = None
+    trackedSubchains = None
+    trackedCities = None
+
     def __init__(self, db, url, username, password, name, chainId, manu=None, itemCodes = None, codeCategoryR=None):
         self.db = db
         self.name = name
@@ -30,6 +60,10 @@ class Chain:
         self.targetManu = manu
         self.itemCodes = itemCodes
         self.codeCategoryR = codeCategoryR
+        self.matcher = ItemMatcher(manu, itemCodes, codeCategoryR)
+        self.backend = getBackend(self.parserBackend)
+        self.downloader = downloader
+        self.downloadFailures = {}
         self.dirname = f"./data/{name}"
         self.url = url
         self.username = username
@@ -38,10 +72,18 @@ class Chain:
         self.priceR = re.compile('^PriceFull')
         self.storeR = re.compile('^Stores')
         self.dateR = re.compile('-(\d{8})\d{4}')
+        # PriceFull<chain>-<store>-<date>
+        self.storeIdR = re.compile('^PriceFull\d+-(\d+)-')
 
         if not os.path.exists(self.dirname):
             os.makedirs(self.dirname)
             self._log("Data folder created")
+        self.manifest = Manifest(self.dirname)
+        # retries and backoff of all http calls, with the chain's retry budget
+        self.retry = RetryPolicy()
+        # store ids in the db, loaded by the first prices file of a scan
+        self._knownStores = None
+        self._storesUpdated = False
         self._log(f"Construing {self.name} chain with {self.username}:{self.password}@{self.url}, searching for products from {self.targetManu}")
 
         self.session = self.login()
@@ -49,6 +91,7 @@ class Chain:
            self._setChain()
         except TypeError:
            self.updateChain(updating=False)
+        self.selectedStores = self._selectStores()
 
     def login(self):
         '''
@@ -64,25 +107,37 @@ class Chain:
         '''
         pass
 
-    def download(self):
+    def download(self, updateDate=None, onDownloaded=None, beforeSubmit=None):
         '''
             Download new data files
             Implemented by each Chain class separately
             ---------------------
             Parameters:
+                updateDate - earliest date to download, latest in the db if None
+                onDownloaded - called with the path of each file when its download completes,
+                    None if it failed, it runs on the download threads and must not block
+                beforeSubmit - called before each file is submitted, may block to hold back
+                    downloads or throw to stop them
             Uses:
             =====================
             Return:
-                downloaded - files downloaded
+                downloaded - files downloaded, in listing order
             Side effects:
                 downloads files to dirname
+                sets downloadFailures, dict of file name to exception
         '''
         page = 0
-        downloaded = []
+        futures = []
         continuePaging = True
         firstOfLast = None
-        updateDate = self._getLatestDate()
+        if updateDate is None:
+            updateDate = self._getLatestDate()
         self._log(f"looking at date after {updateDate}")
+        def downloaded(future):
+            if not future.cancelled() and future.exception() is None:
+                onDownloaded(future.result())
+            else:
+                onDownloaded(None)
         while continuePaging:
             page = page + 1
             links, continuePaging = self.download_page(page, updateDate, firstOfLast)
@@ -90,8 +145,18 @@ class Chain:
                 firstOfLast = None
             else:
                 firstOfLast = links[0]['name']
-            downloaded_files = [self._download_gz(item['name'], item['link'], prior=item.get('prior', None)) for item in links]
-            downloaded = downloaded + downloaded_files
+            # files download while the next page is fetched
+            for item in links:
+                if beforeSubmit is not None:
+                    beforeSubmit()
+                future = self._submitDownload(item)
+                if onDownloaded is not None:
+                    future.add_done_callback(downloaded)
+                futures.append((item['name'], future))
+        downloaded, failures = self.downloader.collect(futures)
+        if len(failures) > 0:
+            self._log(f"Failed downloading {len(failures)} files: {list(failures)}")
+        self.downloadFailures = failures
         downloaded = [d for d in downloaded if d is not None]
         return(downloaded)
 
@@ -133,60 +198,43 @@ class Chain:
         else:
             self._log(f"last update date {updateDate}, fetching files after that date")
             self._log(f"Starting with {len(priceFiles)} files")
-            matchPrice = {f: self._todatetime(self.dateR.search(f).group(1))  for f in priceFiles}
-
-            relFiles = [file for file, date in matchPrice.items() if date > updateDate]
+            relFiles = [file for file in priceFiles if self._isNewer(file, updateDate)]
         self._log(f"Fetching {len(relFiles)} files")
         return relFiles
 
-    def scanStores(self, newDay=True):
+    def scanStores(self, newDay=True, workers=None):
         '''
             Main entry point
             Scan prices files from stores and inserts prices to db
+            New files are parsed as soon as they are downloaded, while the next ones download
             ---------------------
             Parameters:
                 newDay - should download new files
+                workers - number of processes parsing files, PARSE_WORKERS if None, 0 to parse in this process
             Uses:
             =====================
             Return:
             Side effects:
                 updates db
         '''
-        if newDay:
-            newFiles = self.download()
+        if workers is None:
+            workers = PARSE_WORKERS
+        self.retry.resetBudget()
+        self._knownStores = None
+        self._storesUpdated = False
+        updateDate = self._getLatestDate()
+        # files downloaded before, then new files as their downloads complete
         files = self.fileList()
-        missingStore = False
-        for fn in files:
-            storeFile = f"{self.dirname}/{fn}"
-            try:
-                store = Store(self.db, storeFile, self.targetManu, self.itemCodes, self.codeCategoryR, self.chainId)
-            except NoStoreException:
-                self._log(f"Missing store from file {storeFile}")
-                try:
-                    self.updateChain()
-                    # store that was missing hasn't initiated, recap
-                    store = Store(self.db, storeFile, self.targetManu, self.itemCodes, self.codeCategoryR, self.chainId)
-                except NoSuchStoreException:
-                    self._log(f"Store in file {storeFile} missing from latest stores file")
-                    missingStore = True
-                    # removed store, continue
-                except NoStoreException:
-                    self._log(f"Store in file {storeFile} missing and a glitch happened")
-                    missingStore = True
-            except WrongStoreFileException:
-                missingStore = True
-                self._log(f"Store file {storeFile} can't init a store")
-
-            finally:
-                if not missingStore:
-                    items = store.obtainItems()
-                    if len(items) > 0:
-                        prices = store.getPrices(items)
-                        store.insertPrices(prices)
-                    else:
-                        self._log(f"No manufacturer items in this store")
-                missingStore = False
-                store = None
+        stopDownloads = None
+        if newDay:
+            downloaded, stopDownloads = self._startDownloads(updateDate)
+            files = itertools.chain(files, downloaded)
+        try:
+            self._parseFiles(files, workers)
+        finally:
+            # parsing failed or stopped early, don't leave the download thread waiting
+            if stopDownloads is not None:
+                stopDownloads()
 
     def getStoreFile(self, updating):
         '''
@@ -229,7 +277,10 @@ class Chain:
                 downloads file and updates db
         '''
         storeFile = self.getStoreFile(updating=updating)
-        self.obtainStores(storeFile)
+        with profiler.profile('obtainStores', self.chainId, storeFile):
+            self.obtainStores(storeFile)
+        # new stores may be in a tracked subchain or city
+        self.selectedStores = self._selectStores()
      # ========== PRIVATE ==========
     def _getChain(self, chain):
         '''
@@ -282,59 +333,557 @@ class Chain:
         cur.execute(query, (chain,))
         return({ store: sid for sid, store in cur.fetchall()})
 
-    def _download_gz(self, fn, link, prior=None):
+    def _startDownloads(self, updateDate):
+        '''
+            Download new files in a background thread, feeding a parse queue
+            New downloads wait while PARSE_QUEUE files are waiting to be parsed, keeping
+            the downloaded but unparsed files on disk bounded
+            ---------------------
+            Parameters:
+                updateDate - earliest date to download
+            Uses:
+            =====================
+            Return:
+                1. iterator of downloaded file names, as their downloads complete
+                2. function stopping the downloads and waiting for the download thread,
+                    to call when parsing ends, even if the iterator wasn't used
+            Side effects:
+                downloads files to dirname, the db isn't used by the download thread
+                the iterator throws the download error, if download failed
+        '''
+        parseQueue = queue.Queue()
+        # files downloading or waiting to be parsed
+        slots = threading.Semaphore(PARSE_QUEUE + HOST_CONCURRENCY)
+        stop = threading.Event()
+        finished = object()
+        errors = []
+        submitted = 0
+        def beforeSubmit():
+            nonlocal submitted
+            while not slots.acquire(timeout=1):
+                if stop.is_set():
+                    break
+            if stop.is_set():
+                raise DownloadsStoppedException
+            submitted = submitted + 1
+        def produce():
+            try:
+                self.download(updateDate, onDownloaded=parseQueue.put, beforeSubmit=beforeSubmit)
+            except DownloadsStoppedException:
+                self._log("Parsing stopped, stopped downloading")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                parseQueue.put(finished)
+        producer = threading.Thread(target=produce, name=f'download-{self.name}', daemon=True)
+        producer.start()
+
+        def consume():
+            received = 0
+            done = False
+            # downloads report after their future completes, wait for all of them
+            while not done or (received < submitted and len(errors) == 0):
+                path = parseQueue.get()
+                if path is finished:
+                    done = True
+                    continue
+                received = received + 1
+                slots.release()
+                if path is None:
+                    continue
+                fn = os.path.basename(path)
+                if self.priceR.match(fn) and self._isNewer(fn, updateDate):
+                    yield fn
+            if len(errors) > 0:
+                raise errors[0]
+
+        def stopDownloads():
+            stop.set()
+            producer.join()
+        return consume(), stopDownloads
+
+    def _parseFiles(self, files, workers):
+        '''
+            Parse price files and insert their prices, the db is only accessed from this process
+            ---------------------
+            Parameters:
+                files - iterable of file names to scan, repeated names are scanned once
+                workers - number of processes, 0 to parse in this process
+            Uses:
+            =====================
+            Return:
+            Side effects:
+                updates db
+        '''
+        def unique(files):
+            seen = set()
+            for fn in files:
+                if fn not in seen:
+                    seen.add(fn)
+                    yield fn
+        files = unique(files)
+        if workers == 0:
+            for fn in files:
+                storeFile = f"{self.dirname}/{fn}"
+                if not self._precheck(storeFile):
+                    continue
+                store = self._openStore(storeFile)
+                if store is not None:
+                    self._insertItems(store, store.obtainItems())
+            return
+
+        self._log(f"Parsing with {workers} workers")
+        # workers are spawned, forking while the download threads hold locks can deadlock them
+        # spawned workers don't inherit an enabled profiler, they enable it themselves
+        initializer = profiler.enable if profiler.enabled else None
+        initargs = (profiler.report,) if profiler.enabled else ()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=initializer, initargs=initargs) as pool:
+            # results are inserted in order, at most two files per worker are in the pool
+            pending = collections.deque()
+            for fn in files:
+                storeFile = f"{self.dirname}/{fn}"
+                if not self._precheck(storeFile):
+                    continue
+                pending.append((storeFile, pool.submit(parseStoreFile, storeFile, self.matcher, self.chainId, self.backend.name)))
+                if len(pending) >= 2 * workers:
+                    self._insertParsed(*pending.popleft())
+            while len(pending) > 0:
+                self._insertParsed(*pending.popleft())
+
+    def _insertParsed(self, storeFile, future):
+        store = self._openStore(storeFile)
+        if store is None:
+            future.cancel()
+            return
+        self._insertItems(store, future.result())
+
+    def _isNewer(self, fn, updateDate):
+        return self._todatetime(self.dateR.search(fn).group(1)) > updateDate
+
+    def _precheck(self, storeFile):
+        '''
+            Decide from the file header if a prices file should be parsed, before parsing it
+            ---------------------
+            Parameters:
+                storeFile - path to price file
+            Uses:
+                trackedStores
+            =====================
+            Return:
+                True to parse the file, False to skip it
+            Side effects:
+                may update chain stores
+        '''
+        try:
+            header = peekHeader(storeFile, self.backend)
+            if header is None:
+                # header beyond the peeked bytes, Store will check it
+                return True
+            fileChain = int(header['ChainId'])
+            storeId = int(header['StoreId'])
+        except (KeyError, ValueError, TypeError, self.backend.ParseError, EOFError, OSError):
+            self._log(f"Store file {storeFile} can't init a store")
+            return False
+        if fileChain != self.chainId:
+            self._log(f"Store file {storeFile} is of chain {fileChain}")
+            return False
+        # tracked by store id only, the store table isn't needed to skip untracked stores
+        if self.trackedSubchains is None and self.trackedCities is None and not self._isTracked(storeId):
+            logger.debug(f"Chain {self.chainId}: skipping untracked store {storeId} in {storeFile}")
+            return False
+        if self._knownStores is None:
+            self._knownStores = self._getStoreIds()
+        # the stores are updated once a scan, stores still missing after that are skipped
+        if storeId not in self._knownStores and not self._storesUpdated:
+            self._log(f"Missing store {storeId} from file {storeFile}")
+            self._storesUpdated = True
+            try:
+                self.updateChain()
+            except NoSuchStoreException:
+                # latest stores file already in use
+                pass
+            self._knownStores = self._getStoreIds()
+        if storeId not in self._knownStores:
+            self._log(f"Store {storeId} in file {storeFile} missing from latest stores file")
+            return False
+        if not self._isTracked(storeId):
+            logger.debug(f"Chain {self.chainId}: skipping untracked store {storeId} in {storeFile}")
+            return False
+        return True
+
+    def _isTracked(self, storeId):
+        return self.selectedStores is None or storeId in self.selectedStores
+
+    def _selectStores(self):
+        '''
+            Resolve the tracked stores, subchains and cities to store ids
+            ---------------------
+            Parameters:
+            Uses:
+                trackedStores, trackedSubchains, trackedCities
+            =====================
+            Return:
+                set of store ids, None for all stores
+        '''
+        if self.trackedStores is None and self.trackedSubchains is None and self.trackedCities is None:
+            return None
+        selected = set() if self.trackedStores is None else {int(store) for store in self.trackedStores}
+        subchains = [] if self.trackedSubchains is None else list(self.trackedSubchains)
+        cities = [] if self.trackedCities is None else list(self.trackedCities)
+        if len(subchains) > 0 or len(cities) > 0:
+            con = self.db.getConn()
+            cur = con.cursor()
+            query = f'''SELECT store.store
+            FROM store
+            LEFT JOIN store_link ON store_link.store = store.id
+            LEFT JOIN subchain ON subchain.id = store_link.subchain
+            WHERE store.chain = ?
+            AND (subchain.subchainId IN ({','.join(['?']*len(subchains))}) OR store.city IN ({','.join(['?']*len(cities))}))
+            '''
+            cur.execute(query, [self.chainId] + subchains + cities)
+            selected.update(store for store, in cur.fetchall())
+        self._log(f"Tracking {len(selected)} stores")
+        return selected
+
+    def _isSelected(self, fn):
+        '''
+            Should the prices file be downloaded, by the store id in its name
+            ---------------------
+            Parameters:
+                fn - file name
+            Uses:
+                selectedStores
+            =====================
+            Return:
+                True if the store is tracked or the name has no store id
+        '''
+        if self.selectedStores is None:
+            return True
+        match = self.storeIdR.match(fn)
+        return match is None or int(match.group(1)) in self.selectedStores
+
+    def _getStoreIds(self):
+        con = self.db.getConn()
+        cur = con.cursor()
+        query = "SELECT store FROM store WHERE chain = ?"
+        cur.execute(query, (self.chainId,))
+        return {sid for sid, in cur.fetchall()}
+
+    def _openStore(self, storeFile):
+        '''
+            Init a Store from a price file, updates the chain stores if the store is missing
+            ---------------------
+            Parameters:
+                storeFile - path to price file
+            Uses:
+            =====================
+            Return:
+                Store object, None if the file can't be used
+            Side effects:
+                may update chain stores
+        '''
+        try:
+            return Store(self.db, storeFile, self.matcher, self.chainId, backend=self.backend)
+        except NoStoreException:
+            self._log(f"Missing store from file {storeFile}")
+            try:
+                self.updateChain()
+                # store that was missing hasn't initiated, recap
+                return Store(self.db, storeFile, self.matcher, self.chainId, backend=self.backend)
+            except NoSuchStoreException:
+                self._log(f"Store in file {storeFile} missing from latest stores file")
+                # removed store, continue
+            except NoStoreException:
+                self._log(f"Store in file {storeFile} missing and a glitch happened")
+        except WrongStoreFileException:
+            self._log(f"Store file {storeFile} can't init a store")
+        except WrongChainFileException:
+            self._log(f"Store file {storeFile} is of another chain")
+        return None
+
+    def _insertItems(self, store, items):
+        '''
+            Insert the prices of items obtained from a store
+            ---------------------
+            Parameters:
+                store - Store object
+                items - list of Item objects
+            Uses:
+            =====================
+            Return:
+            Side effects:
+                updates db
+        '''
+        if len(items) > 0:
+            prices = store.getPrices(items)
+            store.insertPrices(prices)
+        else:
+            self._log(f"No manufacturer items in this store")
+
+    def _request(self, method, url, session=None, **kwargs):
+        '''
+            Http request with the shared timeout, retry and circuit breaker layer
+            ---------------------
+            Parameters:
+               method - http method
+               url - url
+               session - session to use, the chain session if None
+               kwargs - passed to requests
+            Uses:
+            =====================
+            Return:
+                response
+        '''
+        if session is None:
+            session = self.session
+        return request(session, method, url, self.retry, client=self, **kwargs)
+
+    def _submitDownload(self, item):
+        '''
+            Submit a listed file to the downloader
+            ---------------------
+            Parameters:
+               item - dict of link, name and optional prior
+            Uses:
+            =====================
+            Return:
+                Future of _download_gz
+        '''
+        return self.downloader.submit(item['link'], self._download_gz, item['name'], item['link'], prior=item.get('prior', None))
+
+    def _download_gz(self, fn, link, prior=None, priorSent=None):
         '''
             Download a gzip file
+            Files already in the manifest are skipped (or revalidated with a conditional
+            request if revalidateDownloads is set and they have validators), interrupted
+            downloads are resumed
+            The response is streamed to a partial file, recompressed if needed
+            and renamed into place when complete, files that aren't xml (login or
+            error pages) are dropped and never recorded
             ---------------------
             Parameters:
                fn - name to save
                link - where to download from
                prior - some sites (bina chains) require server-side refreshing
+               priorSent - Future of the prior already requested, prior is only requested again on retries
             Uses:
             =====================
             Return:
                 path to file
             Side effects:
-                downloads file
+                downloads file, updates the manifest
+                throws the request error when out of retries, InvalidDownloadException
         '''
-        self._log(f"Downloading file {link}")
-        counter = 0
-        while True:
-            try:
-                if prior is not None:
-                    self.session.get(prior, verify=False)
-                    self._log("Accessing refreshing point (prior) at {prior}")
-                data = self.session.get(link, verify=False)
-                break
-            except requests.exceptions.ConnectionError:
-                if counter < MAX_SLEEPS:
-                    counter = counter + 1
-                    self._log("ConnectionError with {link}, trying sleeping for {SLEEP_SECS} seconds try #{counter}")
-                    time.sleep(SLEEP_SECS)
-                else:
-                    self._log("Too many ConnectionErrors with {link}, skipping it")
-                    return None
-
-        content = data.content
         filename = f'{self.dirname}/{fn}.gz'
+        present = os.path.exists(filename)
+        if present and not self._isPayload(filename):
+            self._log(f"File {filename} isn't a prices file, downloading it again")
+            os.remove(filename)
+            present = False
+        if present and not self.manifest.isPresent(fn, filename):
+            # downloaded before the manifest was kept
+            self.manifest.record(fn, filename, link)
+        if present and not self._revalidates(fn):
+            self._log(f"File {filename} already downloaded, skipping")
+            return filename
 
-        if content[:2] == ZIP_MAGIC_NUMBER:
-            self._log(f"File {filename} is in ZIP format and will be unzipped")
-            with ZipFile(io.BytesIO(content), "r") as myzip:
-                zipList = myzip.infolist()
-                with myzip.open(zipList[0]) as f:
-                    content = f.read()
-
-        if content[:2] != GZIP_MAGIC_NUMBER:
-            self._log(f'magic number {content[:2]}')
-            self._log(f"File {filename} is ungzipped and will be compressed")
-            content = gzip.compress(content)
-
-        with open(filename, 'wb') as f:
-            f.write(content)
-            self._log(f"Saved to {filename}")
+        self._log(f"Downloading file {link}")
+        def attempt():
+            nonlocal priorSent
+            if priorSent is not None:
+                pending, priorSent = priorSent, None
+                pending.result()
+            elif prior is not None:
+                send(self.session, 'GET', prior, client=self, verify=False)
+                self._log(f"Accessing refreshing point (prior) at {prior}")
+            return self._fetch(fn, link, filename, conditional=present)
+        # a broken stream is retried as a whole, resuming from the partial file
+        validators = self.retry.call(link, attempt)
+
+        if validators is None:
+            self._log(f"File {filename} not modified")
+            return filename
+        partName = self._partName(filename)
+        if not self._isPayload(partName):
+            os.remove(partName)
+            self._log(f"Download of {link} isn't a prices file")
+            raise InvalidDownloadException(fn)
+        self._toGz(self._partName(filename), filename)
+        self.manifest.record(fn, filename, link, validators)
+        self._log(f"Saved to {filename}")
         return filename
 
+    def _fetch(self, fn, link, filename, conditional=False):
+        '''
+            Stream a download to the partial file of filename, resuming it if it exists
+            ---------------------
+            Parameters:
+               fn - name in the manifest
+               link - where to download from
+               filename - final file name
+               conditional - send the recorded validators, the file is kept if not modified
+            Uses:
+            =====================
+            Return:
+                dict of server validators, None if not modified
+            Side effects:
+                writes the partial file
+                throws SessionExpiredException if answered with the login page
+        '''
+        partName = self._partName(filename)
+        # ranges are of the raw file, no transfer compression
+        headers = {'Accept-Encoding': 'identity'}
+        offset = os.path.getsize(partName) if os.path.exists(partName) else 0
+        partial = self.manifest.getPartial(fn) or {}
+        ifRange = partial.get('etag') or partial.get('lastModified')
+        if offset > 0 and ifRange is None:
+            # without a validator a changed file would be appended to the stale part
+            self._log(f"Partial {partName} has no validator, starting over")
+            os.remove(partName)
+            offset = 0
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = ifRange
+        elif conditional:
+            entry = self.manifest.get(fn) or {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+
+        with send(self.session, 'GET', link, client=self, headers=headers, verify=False, stream=True) as data:
+            if data.status_code == 304:
+                return None
+            if data.status_code == 416:
+                # partial file doesn't fit the current file, start over
+                os.remove(partName)
+                return self._fetch(fn, link, filename, conditional)
+            if self._loginExpired(data):
+                raise SessionExpiredException(link)
+            data.raise_for_status()
+            validators = {
+                    'etag': data.headers.get('ETag'),
+                    'lastModified': data.headers.get('Last-Modified'),
+            }
+            if data.status_code == 206:
+                self._log(f"Resuming {filename} from byte {offset}")
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                self.manifest.setPartial(fn, validators)
+            with open(partName, mode) as out:
+                for chunk in iterContent(data, DOWNLOAD_CHUNK, client=self):
+                    out.write(chunk)
+        return validators
+
+    def _isPayload(self, path):
+        '''
+            Is a downloaded file xml, and not an html login or error page
+            ---------------------
+            Parameters:
+               path - gzip, zip or plain file
+            Uses:
+            =====================
+            Return:
+                bool
+        '''
+        try:
+            with open(path, 'rb') as f:
+                magic = f.read(2)
+            if magic == GZIP_MAGIC_NUMBER:
+                with gzip.open(path, 'rb') as f:
+                    head = f.read(PAYLOAD_HEAD)
+            elif magic == ZIP_MAGIC_NUMBER:
+                with ZipFile(path, "r") as myzip, myzip.open(myzip.infolist()[0]) as member:
+                    head = member.read(PAYLOAD_HEAD)
+                if head[:2] == GZIP_MAGIC_NUMBER:
+                    head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+            else:
+                with open(path, 'rb') as f:
+                    head = f.read(PAYLOAD_HEAD)
+        except (OSError, EOFError, BadZipFile, IndexError, zlib.error):
+            return False
+        text = head.decode(sniffEncoding(head) or 'utf-8', 'ignore').lstrip('\ufeff \t\r\n').lower()
+        return text.startswith('<') and not text.startswith(('<!doctype html', '<html'))
+
+    def _revalidates(self, fn):
+        '''
+            Should a downloaded file be re-requested with a conditional request,
+            only when the server sent validators for it
+        '''
+        return self.revalidateDownloads and self.manifest.hasValidators(fn)
+
+    def _loginExpired(self, response):
+        '''
+            Was a download refused or answered with the login page, for sites with a login session
+        '''
+        return False
+
+    def _partName(self, filename):
+        # hidden partial files don't match the price/store file patterns
+        dirname, basename = os.path.split(filename)
+        return f'{dirname}/.{basename}.download'
+
+    def _toGz(self, partName, filename):
+        '''
+            Move a completed download into place as gzip
+            ZIP files are unzipped and plain files compressed, streaming from disk
+            ---------------------
+            Parameters:
+               partName - completed download
+               filename - final file name
+            Uses:
+            =====================
+            Return:
+            Side effects:
+                removes partName, writes filename atomically
+        '''
+        with open(partName, 'rb') as f:
+            magic = f.read(2)
+        if magic == GZIP_MAGIC_NUMBER:
+            os.replace(partName, filename)
+            return
+
+        dirname, basename = os.path.split(filename)
+        fd, tmpName = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}.', suffix='.part')
+        try:
+            if magic == ZIP_MAGIC_NUMBER:
+                self._log(f"File {filename} is in ZIP format and will be unzipped")
+                self._zipToGz(partName, fd)
+            else:
+                self._log(f'magic number {magic}')
+                self._log(f"File {filename} is ungzipped and will be compressed")
+                with os.fdopen(fd, 'wb') as out, open(partName, 'rb') as f:
+                    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=GZIP_LEVEL) as gz:
+                        shutil.copyfileobj(f, gz, DOWNLOAD_CHUNK)
+        except BaseException:
+            os.remove(tmpName)
+            raise
+        os.replace(tmpName, filename)
+        os.remove(partName)
+
+    def _zipToGz(self, zipName, fd):
+        '''
+            Stream the first member of a ZIP file to a gzip file
+            ---------------------
+            Parameters:
+               zipName - ZIP file path
+               fd - open file descriptor to write the gzip to
+            Uses:
+            =====================
+            Return:
+            Side effects:
+                writes to fd and closes it
+        '''
+        with os.fdopen(fd, 'wb') as out, ZipFile(zipName, "r") as myzip:
+            zipList = myzip.infolist()
+            with myzip.open(zipList[0]) as member:
+                if member.peek(2)[:2] == GZIP_MAGIC_NUMBER:
+                    shutil.copyfileobj(member, out, DOWNLOAD_CHUNK)
+                else:
+                    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=GZIP_LEVEL) as gz:
+                        shutil.copyfileobj(member, gz, DOWNLOAD_CHUNK)
 
     def _setChain(self):
         self.chain = self._getChain(self.chainId)
@@ -16,3 +16,31 @@ class NoStoreException(Exception):
 class NoSuchStoreException(Exception):
     def __init__(self):
         pass
+
+'''Raised when a prices file doesn't match any known dialect'''
+class UnknownSchemaException(Exception):
+    def __init__(self):
+        pass
+
+'''Raised when requests to a host are paused after repeated failures'''
+class CircuitOpenException(Exception):
+    def __init__(self, host):
+        super().__init__(host)
+        self.host = host
+
+'''Raised when a downloaded file isn't a prices file, e.g. an html login or error page'''
+class InvalidDownloadException(Exception):
+    def __init__(self, fn):
+        super().__init__(fn)
+        self.fn = fn
+
+'''Raised when a download is answered with the login page, the session expired'''
+class SessionExpiredException(Exception):
+    def __init__(self, url):
+        super().__init__(url)
+        self.url = url
+
+'''Raised in a chain's download thread when its scan stopped before the downloads ended'''
+class DownloadsStoppedException(Exception):
+    def __init__(self):
+        pass
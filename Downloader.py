@@ -0,0 +1,77 @@
+'''
+Concurrent file downloads shared by all chains
+Each host gets its own thread pool sized by its concurrency limit, so a busy host
+never holds threads another host could use, several Cerberus chains share a host and its limit
+'''
+import os
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+# concurrent requests to a single host
+HOST_CONCURRENCY = int(os.environ.get('HOST_CONCURRENCY', 4))
+
+class Downloader:
+    def __init__(self, hostConcurrency=HOST_CONCURRENCY):
+        '''
+        Initialize a downloader
+        ---------------------
+        Parameters:
+            hostConcurrency - concurrent requests per host, or dict of host to limit with a None default
+        =====================
+        Return:
+            Downloader object
+        '''
+        self.hostConcurrency = hostConcurrency
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def submit(self, link, func, *args, **kwargs):
+        '''
+            Run func(*args, **kwargs) on the pool, limited by the host of link
+            ---------------------
+            Parameters:
+                link - url, used for the host limit
+                func - download function
+            =====================
+            Return:
+                Future
+        '''
+        return self._hostPool(urlparse(link).netloc).submit(func, *args, **kwargs)
+
+    def collect(self, futures):
+        '''
+            Wait for submitted jobs
+            ---------------------
+            Parameters:
+                futures - list of (key, Future)
+            =====================
+            Return:
+                1. list of results in order, None for failed jobs
+                2. dict of key to exception of failed jobs
+        '''
+        results = []
+        failures = {}
+        for key, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(f"Download of {key} failed")
+                failures[key] = e
+                results.append(None)
+        return results, failures
+
+    def _hostPool(self, host):
+        with self._lock:
+            pool = self._pools.get(host)
+            if pool is None:
+                limit = self.hostConcurrency
+                if isinstance(limit, dict):
+                    limit = limit.get(host, limit.get(None, HOST_CONCURRENCY))
+                pool = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f'download-{host}')
+                self._pools[host] = pool
+            return pool
+
+downloader = Downloader()
@@ -0,0 +1,271 @@
+'''
+Shared HTTP layer for all chains
+Requests get timeouts and are retried with jittered exponential backoff within a
+retry budget, a circuit breaker per host stops calling a dead platform
+Sessions are pooled per host and login, all sessions share one adapter so
+connections to a host are reused by every chain on it
+'''
+import time
+import socket
+import random
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from loguru import logger
+
+from CustomExceptions import CircuitOpenException
+from Downloader import HOST_CONCURRENCY
+from Scheduler import scheduler
+
+# seconds to connect and between bytes read
+TIMEOUT = (10, 60)
+MAX_RETRIES = 4
+BASE_DELAY = 2
+MAX_DELAY = 120
+# retries a single chain may spend in a run
+RETRY_BUDGET = 50
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+)
+# hosts with kept connection pools
+POOL_HOSTS = 32
+# concurrent requests sent ahead of the downloads of a host (Bina priors)
+PRIOR_CONCURRENCY = HOST_CONCURRENCY
+# kept connections per host, the downloads, the requests ahead of them and a listing request
+POOL_MAXSIZE = HOST_CONCURRENCY + PRIOR_CONCURRENCY + 1
+# seconds idle before tcp keep-alive probes, keeps connections alive between listing pages
+KEEPALIVE_IDLE = 60
+# set by Replay, url rewriting to the replay server and response recording
+redirect = None
+recorder = None
+# consecutive failures that open a host circuit, and seconds until a trial request
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 300
+
+class RetryableStatusException(requests.exceptions.HTTPError):
+    '''Raised for responses worth retrying (429, 5xx)'''
+    pass
+
+RETRY_EXCEPTIONS = RETRY_EXCEPTIONS + (RetryableStatusException,)
+
+class CircuitBreaker:
+    def __init__(self, host, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.host = host
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._openedAt = None
+        self._lock = threading.Lock()
+
+    def before(self):
+        '''
+            Check the circuit before a request, throws CircuitOpenException while open
+            After the cooldown requests go through, one more failure reopens it
+        '''
+        with self._lock:
+            if self._openedAt is not None and time.monotonic() - self._openedAt < self.cooldown:
+                raise CircuitOpenException(self.host)
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._openedAt = None
+
+    def failure(self):
+        with self._lock:
+            self._count = self._count + 1
+            if self._count >= self.failures:
+                if self._openedAt is None:
+                    logger.warning(f"Circuit for {self.host} opened after {self._count} failures")
+                self._openedAt = time.monotonic()
+
+_breakers = {}
+_breakersLock = threading.Lock()
+def getBreaker(url):
+    '''
+        Circuit breaker of the url host, shared by all chains
+    '''
+    host = urlparse(url).netloc
+    with _breakersLock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+        return breaker
+
+class RetryPolicy:
+    def __init__(self, retries=MAX_RETRIES, baseDelay=BASE_DELAY, maxDelay=MAX_DELAY, budget=RETRY_BUDGET):
+        '''
+        Initialize a retry policy, each chain has its own budget
+        ---------------------
+        Parameters:
+            retries - retries of a single call
+            baseDelay - seconds of the first backoff
+            maxDelay - cap of a single backoff
+            budget - total retries allowed to this policy
+        =====================
+        Return:
+            RetryPolicy object
+        '''
+        self.retries = retries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.fullBudget = budget
+        self.budget = budget
+        self._lock = threading.Lock()
+
+    def resetBudget(self):
+        with self._lock:
+            self.budget = self.fullBudget
+
+    def call(self, url, func, *args, **kwargs):
+        '''
+            Call func, retrying on connection errors, timeouts and retryable statuses
+            ---------------------
+            Parameters:
+                url - requested url, for the host circuit breaker
+                func - the call, raising one of RETRY_EXCEPTIONS to be retried
+            =====================
+            Return:
+                func result
+            Side effects:
+                throws the last error when out of retries, CircuitOpenException if the host is down
+        '''
+        breaker = getBreaker(url)
+        attempt = 0
+        while True:
+            breaker.before()
+            try:
+                result = func(*args, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                breaker.failure()
+                if attempt >= self.retries or not self._spend():
+                    logger.warning(f"Giving up on {url} after {attempt + 1} tries: {e}")
+                    raise
+                delay = self._delay(attempt, e)
+                logger.info(f"{type(e).__name__} with {url}, retry #{attempt + 1} in {delay:.1f} seconds")
+                time.sleep(delay)
+                attempt = attempt + 1
+                continue
+            breaker.success()
+            return result
+
+    def _spend(self):
+        with self._lock:
+            if self.budget <= 0:
+                return False
+            self.budget = self.budget - 1
+            return True
+
+    def _delay(self, attempt, e):
+        # full jitter
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        response = getattr(e, 'response', None)
+        if response is not None:
+            retryAfter = response.headers.get('Retry-After')
+            if retryAfter is not None and retryAfter.isdigit():
+                delay = max(delay, min(self.maxDelay, int(retryAfter)))
+        return delay
+
+def send(session, method, url, client=None, **kwargs):
+    '''
+        Send a single request with the default timeout, when the scheduler allows it
+        ---------------------
+        Parameters:
+            session - requests session
+            method - http method
+            url - url
+            client - chain sending the request, for the scheduler
+            kwargs - passed to session.request
+        =====================
+        Return:
+            response
+        Side effects:
+            throws RetryableStatusException for 429 and 5xx responses
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    scheduler.request(url, client)
+    if redirect is not None:
+        url = redirect(url)
+    r = session.request(method, url, **kwargs)
+    if r.status_code in RETRY_STATUSES:
+        r.close()
+        raise RetryableStatusException(f"{r.status_code} for {url}", response=r)
+    if recorder is not None:
+        recorder.record(r)
+    return r
+
+def request(session, method, url, policy, client=None, **kwargs):
+    '''
+        Send a request with timeout, retries and the host circuit breaker
+        ---------------------
+        Parameters:
+            session - requests session
+            method - http method
+            url - url
+            policy - RetryPolicy
+            client - chain sending the request, for the scheduler
+            kwargs - passed to session.request
+        =====================
+        Return:
+            response
+    '''
+    return policy.call(url, send, session, method, url, client=client, **kwargs)
+
+def iterContent(response, size, client=None):
+    '''
+        Iterate a streamed response body within the scheduler bandwidth
+        ---------------------
+        Parameters:
+            response - streamed response
+            size - chunk size
+            client - chain reading it, for its bandwidth share
+        =====================
+        Return:
+            generator of chunks
+    '''
+    for chunk in response.iter_content(size):
+        scheduler.transfer(len(chunk), client)
+        yield chunk
+
+class KeepAliveAdapter(HTTPAdapter):
+    '''HTTPAdapter with tcp keep-alive on its connections'''
+    def init_poolmanager(self, *args, **kwargs):
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE))
+        kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+
+# retries are done by RetryPolicy, not urllib3
+_adapter = KeepAliveAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+_sessions = {}
+_sessionsLock = threading.Lock()
+def getSession(url, login=None):
+    '''
+        Pooled session of a platform host
+        Chains on the same host with the same login share a session and its cookies,
+        different logins get their own cookie jar, all share the connection pools
+        ---------------------
+        Parameters:
+            url - platform url
+            login - user name, None for sites without login
+        =====================
+        Return:
+            requests session
+    '''
+    key = (urlparse(url).netloc, login)
+    with _sessionsLock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', _adapter)
+            session.mount('http://', _adapter)
+            _sessions[key] = session
+        return session
@@ -1,31 +1,35 @@
 class Item:
-    def __init__(self, chainId, store, datetime, xmlObject):
-        self.chainId = chainId
-        self.store = store
-        self.datetime = datetime
-        self._strdate = self.datetime.strftime('%Y-%m-%d %H:%M')
-        self._parse(xmlObject)
+    __slots__ = ('code', 'name', 'manu', 'units', 'price', 'update_date')
 
-    def getChainItem(self):
-        return([self.chainId, self.code, self.name, self.manu, self.units])
+    def __init__(self, xmlObject, tagFields):
+        '''
+        Initialize an item from its xml element
+        File level values (chain, store, file date) are kept by the Store
+        ---------------------
+        Parameters:
+            xmlObject - Item/Product xml element
+            tagFields - dict of file tag to Item field, see Schema.FileSchema
+        =====================
+        Return:
+            Item object
+        '''
+        self.code = None
+        self.name = None
+        self.manu = None
+        self.units = None
+        self.price = None
+        self.update_date = None
+        self._parse(xmlObject, tagFields)
 
-    def getPriceItem(self, item):
-        return([self._strdate, self.store, item, self.update_date, self.price])
+    def getChainItem(self, chainId):
+        return([chainId, self.code, self.name, self.manu, self.units])
 
-    def _parse(self, obj):
-        for elem in obj.iter():
-            if elem.tag == 'ItemCode':
-                self.code = int(elem.text)
-            # ItemNm for KingStore
-            elif elem.tag in  ['ItemName', 'ItemNm']:
-                self.name = elem.text
-            # ManufactureName for MatrixChain
-            elif elem.tag in ['ManufacturerName', 'ManufactureName']:
-                self.manu = elem.text
-            # UnitQty for MatrixChain
-            elif elem.tag in ['UnitOfMeasure', 'UnitQty']:
-                self.units = elem.text
-            elif elem.tag == 'UnitOfMeasurePrice':
-                self.price = elem.text
-            elif elem.tag == 'PriceUpdateDate':
-                self.update_date = elem.text
+    def getPriceItem(self, filedate, store, item):
+        return([filedate, store, item, self.update_date, self.price])
+
+    def _parse(self, obj, tagFields):
+        for elem in obj:
+            field = tagFields.get(elem.tag)
+            if field is not None:
+                setattr(self, field, elem.text)
+        self.code = int(self.code)
@@ -0,0 +1,58 @@
+import re
+
+MATCH_MANU = 'manufacturer'
+MATCH_CODE = 'code'
+MATCH_CATEGORY = 'category'
+
+class ItemMatcher:
+    '''
+    Classifies items by the chain's manufacturer, item codes and code category filters
+    Built once per chain, used per item by Store parsers
+    '''
+    def __init__(self, manu=None, itemCodes=None, codeCategoryR=None):
+        '''
+        Initialize a matcher from the chain's filters
+        ---------------------
+        Parameters:
+            manu - manufacturer name to match exactly
+            itemCodes - iterable of item codes
+            codeCategoryR - regex (compiled or pattern) searched in the item code
+        =====================
+        Return:
+            ItemMatcher object
+        '''
+        self.manu = manu
+        self.itemCodes = frozenset() if itemCodes is None else frozenset(int(code) for code in itemCodes)
+        if codeCategoryR is not None and not isinstance(codeCategoryR, re.Pattern):
+            codeCategoryR = re.compile(codeCategoryR)
+        self.codeCategoryR = codeCategoryR
+
+    def match(self, code, manu=None):
+        '''
+            Classify an item
+            ---------------------
+            Parameters:
+                code - item code text as in the file
+                manu - manufacturer name as in the file
+            =====================
+            Return:
+                matching rule (MATCH_MANU, MATCH_CODE, MATCH_CATEGORY) or None
+        '''
+        if self.manu is not None and manu == self.manu:
+            return MATCH_MANU
+        if code is None:
+            return None
+        if self.itemCodes and self._codeInt(code) in self.itemCodes:
+            return MATCH_CODE
+        if self.codeCategoryR is not None and self.codeCategoryR.search(code) is not None:
+            return MATCH_CATEGORY
+        return None
+
+    def _codeInt(self, code):
+        try:
+            return int(code)
+        except ValueError:
+            return None
+
+    def __repr__(self):
+        return f"ItemMatcher(manu={self.manu}, itemCodes={len(self.itemCodes)}, codeCategoryR={self.codeCategoryR})"
@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+from loguru import logger
+
+MANIFEST_FILE = 'manifest.json'
+HASH_CHUNK = 1024 * 1024
+
+class Manifest:
+    '''
+    Per chain record of downloaded files, kept as json in the chain data folder
+    For each file: size, sha256 of the saved file, link and the server validators
+    (ETag, Last-Modified), plus the validators of an interrupted download for resuming
+    '''
+    def __init__(self, dirname):
+        self.path = f'{dirname}/{MANIFEST_FILE}'
+        self._lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.files = json.load(f)
+            except ValueError:
+                logger.warning(f"Manifest {self.path} is corrupt, starting a new one")
+
+    def get(self, name):
+        with self._lock:
+            return self.files.get(name)
+
+    def isPresent(self, name, filename):
+        '''
+            Is the file downloaded and unchanged on disk
+            ---------------------
+            Parameters:
+                name - file name in the manifest
+                filename - path to the saved file
+            =====================
+            Return:
+                bool
+        '''
+        entry = self.get(name)
+        if entry is None or 'size' not in entry:
+            return False
+        try:
+            return os.path.getsize(filename) == entry['size']
+        except OSError:
+            return False
+
+    def record(self, name, filename, link, validators=None):
+        '''
+            Record a completed download
+            ---------------------
+            Parameters:
+                name - file name in the manifest
+                filename - path to the saved file
+                link - where it was downloaded from
+                validators - dict of etag and lastModified from the server
+            =====================
+            Return:
+            Side effects:
+                saves the manifest
+        '''
+        entry = {
+                'link': link,
+                'size': os.path.getsize(filename),
+                'sha256': self._hash(filename),
+                'downloaded': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        if validators:
+            # servers without validators get none recorded, not nulls
+            entry.update({key: value for key, value in validators.items() if value})
+        with self._lock:
+            self.files[name] = entry
+            self._save()
+
+    def setPartial(self, name, validators):
+        '''
+            Record the validators of a download in progress, used to resume it
+        '''
+        with self._lock:
+            entry = self.files.setdefault(name, {})
+            entry['partial'] = validators
+            self._save()
+
+    def hasValidators(self, name):
+        '''
+            Did the server send an ETag or Last-Modified for the recorded download
+        '''
+        entry = self.get(name)
+        return entry is not None and bool(entry.get('etag') or entry.get('lastModified'))
+
+    def getPartial(self, name):
+        entry = self.get(name)
+        return None if entry is None else entry.get('partial')
+
+    def _hash(self, filename):
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _save(self):
+        # atomic replace, a crash never leaves a half written manifest
+        tmpName = f'{self.path}.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(self.files, f, indent=1)
+        os.replace(tmpName, self.path)
@@ -1,14 +1,12 @@
 import os
 import re
-import gzip
-import xml.etree.ElementTree as ET
-import requests
 
 from lxml import etree
 from loguru import logger
 
 from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException
 from Chain import Chain
+from Http import getSession
 
 removeExtrasR = re.compile(r'-001$')
 class MatrixChain(Chain):
@@ -33,7 +31,7 @@ class MatrixChain(Chain):
         Side effects:
             downloads files to dirname
         '''
-        return requests.Session()
+        return getSession(self.url, self.username)
 
     def download_page(self, page=1, updateDate=None, firstOfLast=None):
         '''
@@ -76,6 +74,9 @@ class MatrixChain(Chain):
                             continuePaging = False
                             self._log(f"Stop paging, reached fileDate: {fileDate}, repeated fetched: {firstOfLast == elem.text}")
                             break
+                        if not self._isSelected(elem.text):
+                            skip = True
+                            continue
                         priceFileName = removeExtrasR.sub('', elem.text)
 
                 if priceFileName is not None and link is not None:
@@ -134,10 +135,8 @@ class MatrixChain(Chain):
         storesIns = {}
         storeLinks = {}
 
-        with gzip.open(fn, 'rt') as f:
-            data = f.read()
-            context = ET.fromstring(data)
-        storesElem = context.find('.//Branches')
+        context = self.backend.parse(fn)
+        storesElem = self.backend.find(context, './/Branches')
         for store in storesElem:
             chainId = int(store.find('ChainID').text)
             # TODO manual override for Victory, wrong chain ID
@@ -186,7 +185,7 @@ class MatrixChain(Chain):
         '''
 
         self._log(f"searching for table for file type {fType}")
-        r = self.session.get(f'{self.url}/NBCompetitionRegulations.aspx', params={
+        r = self._request('GET', f'{self.url}/NBCompetitionRegulations.aspx', params={
             'code': self.chainId,
             'fileType': fType
             })
@@ -1,16 +1,20 @@
 import os
 import re
-import gzip
-import xml.etree.ElementTree as ET
-import requests
+import json
+import datetime
 
 from lxml import etree
 from loguru import logger
 
 from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException
 from Chain import Chain
+from Http import getSession
 
 dateLinkR = re.compile('\d{8}/')
+# listings of closed date folders, in the chain data folder
+FOLDER_CACHE = 'folders.json'
+# days after which a date folder gets no new files
+CLOSED_FOLDER_DAYS = 2
 class MegaChain(Chain):
     '''
     The basic functions each Chain should implement
@@ -32,11 +36,13 @@ class MegaChain(Chain):
         Side effects:
             downloads files to dirname
         '''
-        return requests.Session()
+        return getSession(self.url, self.username)
 
     def download_page(self, page=1, updateDate=None, firstOfLast=None):
         '''
             get PriceFull file list created after updateDate
+            Date folders from updateDate are listed concurrently, listings of
+            closed folders are cached
             ---------------------
             Parameters:
                 updateDate - update date of reference
@@ -51,16 +57,25 @@ class MegaChain(Chain):
         if updateDate is None:
             updateDate = self._getLatestDate()
         folders = self._getFolderContent(reFilter=dateLinkR)
+        # files are newer by their day (see Chain._isNewer), the update date's folder isn't used
         relFolders = [folder for folder in folders if self._todatetime(folder[:-1]) > updateDate]
+        self._log(f"Listing {len(relFolders)} folders after {updateDate}")
+
+        cache = self._loadFolderCache(folders)
+        futures = [(folder, self.downloader.submit(self.url, self._listFolder, folder)) for folder in relFolders if folder not in cache]
+        listings = dict(cache)
+        closedDay = datetime.datetime.now() - datetime.timedelta(CLOSED_FOLDER_DAYS)
+        for folder, future in futures:
+            listings[folder] = future.result()
+            if self._todatetime(folder[:-1]) < closedDay:
+                cache[folder] = listings[folder]
+        self._saveFolderCache(cache)
+
         links = []
-        for folder in folders:
-            date = self._todatetime(folder[:-1])
-            if date < updateDate:
-                self._log(f"Stop paging, reached foldr date: {folder}")
-                break
-            files = self._getFolderContent(folder=folder, reFilter=self.priceR)
+        for folder in relFolders:
+            files = [file for file in listings[folder] if self.priceR.match(file) and self._isSelected(file)]
             self._log(f"Found {len(files)} links in folder {folder}")
-            links = links + [{'link': f'{self.url}/{folder}{file}', 'name': file} for file in files]
+            links.extend({'link': f'{self.url}/{folder}{file}', 'name': file} for file in files)
         return links, False
 
     def getStoreFile(self, updating):
@@ -97,10 +112,8 @@ class MegaChain(Chain):
                 list of Item objects
         '''
         self._log(f"Obtaining stores from {fn}")
-        with gzip.open(fn, 'rt', encoding='utf-16') as f:
-            data = f.read()
-            context = ET.fromstring(data)
-        chainId = int(context.find('.//ChainId').text)
+        context = self.backend.parse(fn)
+        chainId = int(self.backend.find(context, './/ChainId').text)
         if self.chainId is not None and chainId != self.chainId:
             # chainId in file should be like setup
             logger.error(f"Chain {self.chainId}: file with wrong chain Id {chainId} supplied {fn}")
@@ -113,7 +126,7 @@ class MegaChain(Chain):
         subchains = self._getSubchains(self.chainId)
         stores = self._getStores(self.chainId)
 
-        subchainsElem = context.find('.//SubChains')
+        subchainsElem = self.backend.find(context, './/SubChains')
         storesIns = {}
         storeLinks = {}
         for sc in subchainsElem:
@@ -154,15 +167,58 @@ class MegaChain(Chain):
         '''
 
         self._log(f"searching for table for files in folder {folder} regex {reFilter}")
-        r = self.session.get(f'{self.url}/{folder}')
+        if reFilter is None:
+            return self._listFolder(folder, links=False)
+        return [link for link in self._listFolder(folder) if reFilter.match(link)]
+
+    def _listFolder(self, folder, links=True):
+        '''
+            All links of a folder
+            ---------------------
+            Parameters:
+                folder - folder, '' for the root
+                links - return hrefs, else the link elements
+            Uses:
+            =====================
+            Return:
+                list of links
+            Side effects:
+        '''
+        r = self._request('GET', f'{self.url}/{folder}')
         res = r.text
         html = etree.HTML(res)
         linksXml = html.findall(".//td[@valign='top']/a")
-        if reFilter is None:
-            relLinks = linksXml
-        else:
-            relLinks = [linkXml.attrib['href'] for linkXml in linksXml if reFilter.match(linkXml.attrib['href'])]
-        return(relLinks)
+        if not links:
+            return linksXml
+        return [linkXml.attrib['href'] for linkXml in linksXml]
+
+    def _loadFolderCache(self, folders):
+        '''
+            Cached listings of closed folders still on the site
+            ---------------------
+            Parameters:
+                folders - date folders on the site
+            =====================
+            Return:
+                dict of folder to its links
+        '''
+        path = f'{self.dirname}/{FOLDER_CACHE}'
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            self._log(f"Folder cache {path} is corrupt, listing all folders")
+            return {}
+        current = set(folders)
+        return {folder: links for folder, links in cache.items() if folder in current}
+
+    def _saveFolderCache(self, cache):
+        path = f'{self.dirname}/{FOLDER_CACHE}'
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(f'{path}.tmp', path)
 
 class YBitan(MegaChain):
     def __init__(self, db):
@@ -0,0 +1,162 @@
+'''
+Memory profiling mode built on tracemalloc
+Enabled by the MEMORY_PROFILE env var (1 or a report path) or profiler.enable()
+Every profiled block appends a JSON line to the report, also from process pool workers
+The allocation sites reported are the ones holding memory at the block's peak, a sampling
+thread snapshots the traced memory whenever it grows past the last snapshot
+'''
+import os
+import json
+import time
+import datetime
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from loguru import logger
+
+REPORT_FILE = './logs/memory_profile.jsonl'
+TOP_SITES = 10
+# seconds between samples of the traced memory, and growth over the last snapshot that takes a new one
+PEAK_SAMPLE_SECS = 0.05
+PEAK_GROWTH = 1.1
+
+class PeakSampler:
+    def __init__(self, interval=PEAK_SAMPLE_SECS, growth=PEAK_GROWTH):
+        '''
+        Initialize a sampler of the snapshot closest to the traced memory peak
+        ---------------------
+        Parameters:
+            interval - seconds between samples
+            growth - ratio over the last snapshot's size that takes a new snapshot
+        =====================
+        Return:
+            PeakSampler object
+        '''
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self._size = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+            Stop sampling
+            ---------------------
+            Parameters:
+            =====================
+            Return:
+                snapshot taken closest to the peak
+        '''
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return self.snapshot
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if self.snapshot is None or current > self._size * self.growth:
+            self.snapshot = tracemalloc.take_snapshot()
+            self._size = current
+
+class MemoryProfiler:
+    def __init__(self, report=None, top=TOP_SITES):
+        '''
+        Initialize a profiler, disabled until enable is called
+        ---------------------
+        Parameters:
+            report - path of the JSON lines report
+            top - number of allocation sites to record per block
+        =====================
+        Return:
+            MemoryProfiler object
+        '''
+        self.enabled = False
+        self.report = report
+        self.top = top
+        self._depth = 0
+
+    def enable(self, report=None):
+        if report is not None:
+            self.report = report
+        if self.report is None:
+            self.report = REPORT_FILE
+        dirname = os.path.dirname(self.report)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+        logger.info(f"Memory profiling to {self.report}")
+
+    def profile(self, kind, chainId, fn):
+        '''
+            Profile a block, no-op when disabled
+            ---------------------
+            Parameters:
+                kind - what is profiled (Store, obtainItems, obtainStores)
+                chainId - chain of the file
+                fn - file name
+            =====================
+            Return:
+                context manager
+        '''
+        if not self.enabled:
+            return nullcontext()
+        return self._profile(kind, chainId, fn)
+
+    @contextmanager
+    def _profile(self, kind, chainId, fn):
+        # nested blocks keep the peak of the enclosing block
+        if self._depth == 0:
+            tracemalloc.reset_peak()
+        self._depth = self._depth + 1
+        start = time.perf_counter()
+        sampler = PeakSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = sampler.stop()
+            self._depth = self._depth - 1
+            self._write(kind, chainId, fn, peak, seconds, snapshot.statistics('lineno')[:self.top])
+
+    def _write(self, kind, chainId, fn, peak, seconds, stats):
+        try:
+            fileSize = os.path.getsize(fn)
+        except (OSError, TypeError):
+            fileSize = None
+        record = {
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'pid': os.getpid(),
+                'kind': kind,
+                'chain': chainId,
+                'file': fn,
+                'fileSize': fileSize,
+                'seconds': round(seconds, 3),
+                'peakKB': peak // 1024,
+                'top': [{
+                    'site': str(stat.traceback),
+                    'sizeKB': stat.size // 1024,
+                    'count': stat.count,
+                    } for stat in stats],
+        }
+        # single small appends, safe with several processes writing
+        with open(self.report, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+profiler = MemoryProfiler()
+if os.environ.get('MEMORY_PROFILE'):
+    profiler.enable(None if os.environ['MEMORY_PROFILE'] == '1' else os.environ['MEMORY_PROFILE'])
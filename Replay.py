@@ -0,0 +1,333 @@
+'''
+Offline record/replay of the price sites
+Recording captures every response the chains get (listings, CSRF pages, priors and files)
+to a cassette folder, replaying serves them from a local server with configurable
+latency, bandwidth and injected errors, so downloads can be measured with no network
+    python Replay.py record --chains Shufersal RamiLevy
+    python Replay.py replay --chains Shufersal RamiLevy --latency 0.1 --bandwidth 2000000 --error-rate 0.05
+'''
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import http.server
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from loguru import logger
+
+import Http
+from Scheduler import scheduler
+from DBConn import DB
+from Shufersal import Shufersal
+from MegaChain import YBitan
+from BinaChain import KingStore
+from CerberusChain import RamiLevy, Yohananof
+from MatrixChain import Victory
+
+CASSETTE_DIR = './cassettes'
+WORK_DIR = './replay'
+INDEX_FILE = 'index.json'
+# response headers kept in the cassette
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+REPLAY_CHUNK = 16 * 1024
+
+# a chain of each platform
+CHAINS = {
+        'Shufersal': Shufersal,
+        'RamiLevy': RamiLevy,
+        'Yohananof': Yohananof,
+        'KingStore': KingStore,
+        'YBitan': YBitan,
+        'Victory': Victory,
+}
+
+def requestKey(method, url, body=None):
+    '''
+        Key of a request in the cassette, query and form fields are sorted
+        ---------------------
+        Parameters:
+            method - http method
+            url - full url with the query
+            body - request body, str or bytes
+        =====================
+        Return:
+            str key
+    '''
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    if body:
+        body = urlencode(sorted(parse_qsl(body, keep_blank_values=True)))
+    return f"{method} {parts.scheme}://{parts.netloc}{parts.path}?{query} {body or ''}"
+
+class Recorder:
+    def __init__(self, dirname=CASSETTE_DIR):
+        '''
+        Initialize a recorder, responses are added to the cassette in dirname
+        ---------------------
+        Parameters:
+            dirname - cassette folder
+        =====================
+        Return:
+            Recorder object
+        '''
+        self.dirname = dirname
+        self.index = loadIndex(dirname)
+        self._lock = threading.Lock()
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def install(self):
+        Http.recorder = self
+
+    def record(self, response):
+        '''
+            Save a response, keyed by the request that started it (before redirects)
+            ---------------------
+            Parameters:
+                response - requests response
+            =====================
+            Return:
+            Side effects:
+                reads the whole response body, writes the body and the index
+        '''
+        request = response.history[0].request if response.history else response.request
+        key = requestKey(request.method, request.url, request.body)
+        bodyName = f"{hashlib.sha1(key.encode()).hexdigest()}.body"
+        with open(f'{self.dirname}/{bodyName}', 'wb') as f:
+            f.write(response.content)
+        entry = {
+                'method': request.method,
+                'url': request.url,
+                'status': response.status_code,
+                'headers': {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers},
+                'body': bodyName,
+        }
+        with self._lock:
+            self.index[key] = entry
+            tmpName = f'{self.dirname}/{INDEX_FILE}.tmp'
+            with open(tmpName, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmpName, f'{self.dirname}/{INDEX_FILE}')
+        logger.info(f"Recorded {key} ({len(response.content)} bytes)")
+
+def loadIndex(dirname):
+    path = f'{dirname}/{INDEX_FILE}'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+class ReplayServer:
+    def __init__(self, dirname=CASSETTE_DIR, latency=0, bandwidth=None, errorRate=0, errorStatus=503, resetRate=0, seed=0):
+        '''
+        Initialize a replay server of a cassette
+        ---------------------
+        Parameters:
+            dirname - cassette folder
+            latency - seconds before each response
+            bandwidth - bytes per second of each response, None for unlimited
+            errorRate - fraction of requests answered with errorStatus
+            errorStatus - status of injected errors
+            resetRate - fraction of responses cut in the middle of the body
+            seed - random seed of injected errors
+        =====================
+        Return:
+            ReplayServer object
+        '''
+        self.dirname = dirname
+        self.index = loadIndex(dirname)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.resetRate = resetRate
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'resets': 0, 'missing': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, port=0):
+        '''
+            Serve in a background thread and route the chains' requests to it
+            ---------------------
+            Parameters:
+                port - port to listen on, 0 for any free port
+            =====================
+            Return:
+                base url of the server
+            Side effects:
+                sets Http.redirect
+        '''
+        replay = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                replay._serve(self)
+            def do_POST(self):
+                replay._serve(self)
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{self._server.server_address[1]}'
+        def redirect(url):
+            parts = urlsplit(url)
+            query = f'?{parts.query}' if parts.query else ''
+            return f'{base}/{parts.scheme}/{parts.netloc}{parts.path}{query}'
+        Http.redirect = redirect
+        logger.info(f"Replaying {len(self.index)} responses from {base}")
+        return base
+
+    def stop(self):
+        Http.redirect = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _serve(self, handler):
+        # path is /scheme/host/path
+        _, scheme, rest = handler.path.split('/', 2)
+        netloc, _, path = rest.partition('/')
+        length = int(handler.headers.get('Content-Length', 0))
+        body = handler.rfile.read(length) if length > 0 else None
+        key = requestKey(handler.command, f'{scheme}://{netloc}/{path}', body)
+        entry = self.index.get(key)
+        with self._lock:
+            self.stats['requests'] = self.stats['requests'] + 1
+            error = self._random.random() < self.errorRate
+            reset = self._random.random() < self.resetRate
+        if self.latency:
+            time.sleep(self.latency)
+        if entry is None:
+            logger.warning(f"Not in cassette: {key}")
+            self._count('missing')
+            self._reply(handler, 404, {}, b'')
+            return
+        if error:
+            self._count('errors')
+            self._reply(handler, self.errorStatus, {}, b'')
+            return
+
+        with open(f"{self.dirname}/{entry['body']}", 'rb') as f:
+            data = f.read()
+        status = entry['status']
+        headers = dict(entry['headers'])
+        etag = headers.get('ETag')
+        if etag is not None and handler.headers.get('If-None-Match') == etag:
+            self._reply(handler, 304, {'ETag': etag}, b'')
+            return
+        rangeHeader = handler.headers.get('Range')
+        if status == 200 and rangeHeader is not None and rangeHeader.startswith('bytes='):
+            start = int(rangeHeader[len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self._reply(handler, 416, {}, b'')
+                return
+            headers['Content-Range'] = f'bytes {start}-{len(data) - 1}/{len(data)}'
+            status = 206
+            data = data[start:]
+        if reset:
+            self._count('resets')
+        self._reply(handler, status, headers, data, reset)
+
+    def _reply(self, handler, status, headers, data, reset=False):
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        # a reset response stops in the middle of the body and drops the connection
+        end = len(data) // 2 if reset else len(data)
+        try:
+            for start in range(0, end, REPLAY_CHUNK):
+                chunk = data[start:min(end, start + REPLAY_CHUNK)]
+                handler.wfile.write(chunk)
+                self._count('bytes', len(chunk))
+                if self.bandwidth:
+                    time.sleep(len(chunk) / self.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            reset = True
+        if reset:
+            handler.close_connection = True
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] = self.stats[stat] + n
+
+def runChains(names, scan=False):
+    '''
+        Construct the chains and download (or scan) them, in the current folder
+        ---------------------
+        Parameters:
+            names - keys of CHAINS
+            scan - run scanStores, else only download
+        =====================
+        Return:
+            list of result dicts
+    '''
+    db = DB()
+    db.dbStruct()
+    results = []
+    for name in names:
+        start = time.perf_counter()
+        chain = CHAINS[name](db)
+        setup = time.perf_counter() - start
+        start = time.perf_counter()
+        if scan:
+            chain.scanStores()
+            downloaded = None
+        else:
+            downloaded = chain.download()
+        res = {
+                'chain': name,
+                'setupSeconds': setup,
+                'seconds': time.perf_counter() - start,
+                'files': None if downloaded is None else len(downloaded),
+                'failures': len(chain.downloadFailures),
+        }
+        print(f"{name:>10} setup {res['setupSeconds']:>7.2f}s {'scan' if scan else 'download'} {res['seconds']:>7.2f}s "
+                f"files {res['files']} failures {res['failures']}")
+        results.append(res)
+    # queueing delays of the scheduler, for tuning its limits
+    for (name, kind), d in sorted(scheduler.stats().items()):
+        print(f"{name:>10} {kind:>9} delayed {d['waited']}/{d['count']} total {d['total']:.2f}s max {d['max']:.2f}s")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline record/replay of the price sites")
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--cassette', default=CASSETTE_DIR, help="cassette folder")
+    parser.add_argument('--workdir', default=WORK_DIR, help="folder of the db and downloaded data")
+    parser.add_argument('--chains', nargs='+', choices=list(CHAINS), default=list(CHAINS))
+    parser.add_argument('--scan', action='store_true', help="run scanStores, not only downloads")
+    parser.add_argument('--latency', type=float, default=0, help="seconds before each response")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes per second of each response")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests failing")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--reset-rate', type=float, default=0, help="fraction of responses cut mid body")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cassette = os.path.abspath(args.cassette)
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    if args.mode == 'record':
+        os.chdir(args.workdir)
+        Recorder(cassette).install()
+        runChains(args.chains, args.scan)
+    else:
+        # every replay starts with no downloaded files
+        os.chdir(tempfile.mkdtemp(prefix='run-', dir=args.workdir))
+        server = ReplayServer(cassette, args.latency, args.bandwidth, args.error_rate, args.error_status, args.reset_rate, args.seed)
+        server.start()
+        try:
+            runChains(args.chains, args.scan)
+        finally:
+            server.stop()
+        print(server.stats)
@@ -0,0 +1,190 @@
+'''
+Central scheduler of all chains' http traffic
+Token buckets limit the requests per second to each host (configured per platform class)
+and the total download bandwidth, which is shared fairly between the chains downloading
+Time spent waiting for tokens is kept per chain, see report
+'''
+import os
+import time
+import threading
+from urllib.parse import urlparse
+
+from loguru import logger
+
+# total download bytes per second, 0 for unlimited
+GLOBAL_BANDWIDTH = int(os.environ.get('GLOBAL_BANDWIDTH', 0))
+# requests per second and burst per host, by platform class name
+PLATFORM_LIMITS = {
+        # ten chains share a single host
+        'CerberusChain': {'requestsPerSec': 4, 'burst': 8},
+        'BinaChain': {'requestsPerSec': 2, 'burst': 4},
+        'MegaChain': {'requestsPerSec': 4, 'burst': 8},
+        'MatrixChain': {'requestsPerSec': 2, 'burst': 4},
+        'Shufersal': {'requestsPerSec': 5, 'burst': 10},
+}
+DEFAULT_LIMITS = {'requestsPerSec': 4, 'burst': 8}
+# seconds since its last transfer a chain counts for the bandwidth share
+ACTIVE_WINDOW = 5
+# seconds of bandwidth a bucket can save up
+BANDWIDTH_BURST = 0.25
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        '''
+        Initialize a full token bucket
+        ---------------------
+        Parameters:
+            rate - tokens added per second
+            burst - bucket size
+        =====================
+        Return:
+            TokenBucket object
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        '''
+            Take n tokens, the bucket may go into debt so callers are served in order
+            ---------------------
+            Parameters:
+                n - tokens
+            =====================
+            Return:
+                seconds to wait before using them
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens = self.tokens - n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def setRate(self, rate, burst):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.rate = rate
+            self.burst = burst
+
+class Scheduler:
+    def __init__(self, bandwidth=GLOBAL_BANDWIDTH, limits=PLATFORM_LIMITS):
+        '''
+        Initialize a scheduler
+        ---------------------
+        Parameters:
+            bandwidth - total bytes per second, 0 for unlimited
+            limits - dict of platform class name to requestsPerSec and burst
+        =====================
+        Return:
+            Scheduler object
+        '''
+        self.bandwidth = bandwidth
+        self.limits = limits
+        self._hosts = {}
+        self._bandwidth = TokenBucket(bandwidth, bandwidth * BANDWIDTH_BURST) if bandwidth else None
+        self._chains = {}
+        self._lastActive = {}
+        self._delays = {}
+        self._lock = threading.Lock()
+
+    def request(self, url, client=None):
+        '''
+            Wait for the host of url to allow another request
+            ---------------------
+            Parameters:
+                url - requested url
+                client - chain making the request, None if unknown
+            =====================
+            Return:
+            Side effects:
+                sleeps, records the queueing delay
+        '''
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._hosts.get(host)
+            if bucket is None:
+                limits = self._platformLimits(client)
+                bucket = TokenBucket(limits['requestsPerSec'], limits['burst'])
+                self._hosts[host] = bucket
+        self._wait(client, 'request', bucket.reserve())
+
+    def transfer(self, n, client=None):
+        '''
+            Account n downloaded bytes against the bandwidth cap and the chain's share
+            ---------------------
+            Parameters:
+                n - bytes read
+                client - chain downloading, None if unknown
+            =====================
+            Return:
+            Side effects:
+                sleeps, records the queueing delay
+        '''
+        if self._bandwidth is None:
+            return
+        name = self._name(client)
+        now = time.monotonic()
+        with self._lock:
+            self._lastActive[name] = now
+            active = sum(1 for t in self._lastActive.values() if now - t < ACTIVE_WINDOW)
+            share = self.bandwidth / max(1, active)
+            bucket = self._chains.get(name)
+            if bucket is None:
+                bucket = TokenBucket(share, share * BANDWIDTH_BURST)
+                self._chains[name] = bucket
+        if bucket.rate != share:
+            bucket.setRate(share, share * BANDWIDTH_BURST)
+        # the chain waits for its share and the whole link
+        self._wait(client, 'bandwidth', max(bucket.reserve(n), self._bandwidth.reserve(n)))
+
+    def stats(self):
+        '''
+            Queueing delays
+            ---------------------
+            Parameters:
+            =====================
+            Return:
+                dict of (chain name, kind) to dict of count, waited (count of delayed),
+                total and max seconds
+        '''
+        with self._lock:
+            return {key: dict(value) for key, value in self._delays.items()}
+
+    def report(self):
+        for (name, kind), d in sorted(self.stats().items()):
+            logger.info(f"Scheduler {name} {kind}: {d['waited']}/{d['count']} delayed, "
+                    f"total {d['total']:.2f} seconds, max {d['max']:.2f} seconds")
+
+    def _wait(self, client, kind, delay):
+        key = (self._name(client), kind)
+        with self._lock:
+            d = self._delays.get(key)
+            if d is None:
+                d = {'count': 0, 'waited': 0, 'total': 0.0, 'max': 0.0}
+                self._delays[key] = d
+            d['count'] = d['count'] + 1
+            if delay > 0:
+                d['waited'] = d['waited'] + 1
+                d['total'] = d['total'] + delay
+                d['max'] = max(d['max'], delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _name(self, client):
+        return 'unknown' if client is None else client.name
+
+    def _platformLimits(self, client):
+        if client is not None:
+            for cls in type(client).__mro__:
+                if cls.__name__ in self.limits:
+                    return self.limits[cls.__name__]
+        return DEFAULT_LIMITS
+
+scheduler = Scheduler()
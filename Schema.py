@@ -0,0 +1,229 @@
+'''
+Prices file dialects
+Each platform publishes a different xml shape, the dialect is detected once per file
+and the parser gets a fixed tag map, adding a dialect is adding a profile
+'''
+from loguru import logger
+
+from CustomExceptions import UnknownSchemaException
+
+# Aliases are in order of preference, the first alias present in the file is used
+PROFILES = [
+        {
+            'name': 'items',
+            'rootTags': ('root', 'Root'),
+            'containerTag': 'Items',
+            'itemTag': 'Item',
+            'header': {
+                'ChainId': ('ChainId', 'ChainID'),
+                'SubChainId': ('SubChainId', 'SubChainID'),
+                'StoreId': ('StoreId', 'StoreID'),
+            },
+            'fields': {
+                'code': ('ItemCode',),
+                # ItemNm for KingStore
+                'name': ('ItemName', 'ItemNm'),
+                'manu': ('ManufacturerName', 'ManufactureName'),
+                'units': ('UnitOfMeasure', 'UnitQty'),
+                'price': ('UnitOfMeasurePrice',),
+                'update_date': ('PriceUpdateDate',),
+            },
+        },
+        {
+            # MatrixChain
+            'name': 'products',
+            'rootTags': ('Prices',),
+            'containerTag': 'Products',
+            'itemTag': 'Product',
+            'header': {
+                'ChainId': ('ChainID', 'ChainId'),
+                'SubChainId': ('SubChainID', 'SubChainId'),
+                'StoreId': ('StoreID', 'StoreId'),
+            },
+            'fields': {
+                'code': ('ItemCode',),
+                'name': ('ItemName', 'ItemNm'),
+                'manu': ('ManufactureName', 'ManufacturerName'),
+                'units': ('UnitQty', 'UnitOfMeasure'),
+                'price': ('UnitOfMeasurePrice',),
+                'update_date': ('PriceUpdateDate',),
+            },
+        },
+]
+ITEM_TAGS = {profile['itemTag'] for profile in PROFILES}
+# decompressed bytes read to find the header fields, the header ends in the first few hundred
+HEAD_SIZE = 8 * 1024
+CONTAINER_TAGS = {profile['containerTag'] for profile in PROFILES}
+
+class FileSchema:
+    '''
+    Fixed tags of a single prices file
+    '''
+    def __init__(self, profile, headerTags, recordTags):
+        '''
+        Resolve the profile aliases against the tags seen in the file
+        ---------------------
+        Parameters:
+            profile - profile dict from PROFILES
+            headerTags - tags seen before the first record
+            recordTags - tags of the first record's elements
+        =====================
+        Return:
+            FileSchema object
+        '''
+        self.name = profile['name']
+        self.containerTag = profile['containerTag']
+        self.itemTag = profile['itemTag']
+        self.headerMap = self._resolve(profile['header'], headerTags)
+        self.itemMap = self._resolveItems(profile['fields'], recordTags)
+        fieldTags = self._resolve(profile['fields'], recordTags)
+        fieldTags = {field: tag for tag, field in fieldTags.items()}
+        self.codeTag = fieldTags.get('code', profile['fields']['code'][0])
+        self.manuTag = fieldTags.get('manu', profile['fields']['manu'][0])
+
+    def _resolve(self, aliases, seen):
+        '''
+            map of file tag to field, one tag per field
+        '''
+        resolved = {}
+        for field, tags in aliases.items():
+            for tag in tags:
+                if tag in seen:
+                    resolved[tag] = field
+                    break
+        return resolved
+
+    def _resolveItems(self, aliases, seen):
+        '''
+            map of file tag to field for the records, every alias of a field is mapped
+            since optional fields may be missing from the first record, aliases after
+            one seen in the first record are left out
+        '''
+        resolved = {}
+        for field, tags in aliases.items():
+            for tag in tags:
+                resolved[tag] = field
+                if tag in seen:
+                    break
+        return resolved
+
+    def __repr__(self):
+        return f"FileSchema({self.name})"
+
+def findProfile(rootTag, containerTag=None, itemTag=None):
+    '''
+        Find the profile of a file
+        ---------------------
+        Parameters:
+            rootTag - tag of the root element
+            containerTag - tag of the records container if reached
+            itemTag - tag of the first record if reached
+        =====================
+        Return:
+            profile dict
+        Side effects:
+            throws UnknownSchemaException
+    '''
+    for profile in PROFILES:
+        if itemTag is not None:
+            if itemTag == profile['itemTag']:
+                return profile
+        elif containerTag is not None:
+            if containerTag == profile['containerTag']:
+                return profile
+        elif rootTag in profile['rootTags']:
+            return profile
+    raise UnknownSchemaException
+
+def detectSchema(fn, backend):
+    '''
+        Detect the dialect of a prices file from its root, header and first record
+        ---------------------
+        Parameters:
+            fn - file name
+            backend - xml parsing backend
+        =====================
+        Return:
+            1. FileSchema
+            2. dict of header field (ChainId, SubChainId, StoreId) to text
+        Side effects:
+            throws UnknownSchemaException
+    '''
+    rootTag = None
+    containerTag = None
+    itemTag = None
+    header = {}
+    recordTags = set()
+    events = backend.iterEvents(fn)
+    for event, elem in events:
+        if event == "start":
+            if rootTag is None:
+                rootTag = elem.tag
+            elif elem.tag in CONTAINER_TAGS:
+                containerTag = elem.tag
+            elif itemTag is None and elem.tag in ITEM_TAGS:
+                itemTag = elem.tag
+        elif itemTag is None:
+            header[elem.tag] = elem.text
+        elif elem.tag == itemTag:
+            break
+        else:
+            recordTags.add(elem.tag)
+    events.close()
+    if rootTag is None:
+        raise UnknownSchemaException
+
+    schema = FileSchema(findProfile(rootTag, containerTag, itemTag), header, recordTags)
+    logger.debug(f"File {fn} detected as {schema}")
+    return schema, {field: header[tag] for tag, field in schema.headerMap.items()}
+
+def peekHeader(fn, backend, size=HEAD_SIZE):
+    '''
+        Read the header fields from the first bytes of a prices file, without parsing it
+        ---------------------
+        Parameters:
+            fn - file name
+            backend - xml parsing backend
+            size - decompressed bytes to read
+        =====================
+        Return:
+            dict of header field (ChainId, SubChainId, StoreId) to text,
+            None if the header or the dialect can't be told from size bytes
+        Side effects:
+            throws backend.ParseError
+    '''
+    rootTag = None
+    containerTag = None
+    itemTag = None
+    header = {}
+    events = backend.iterEvents(fn, head=size)
+    for event, elem in events:
+        if event == "start":
+            if rootTag is None:
+                rootTag = elem.tag
+            elif elem.tag in CONTAINER_TAGS:
+                containerTag = elem.tag
+                break
+            elif elem.tag in ITEM_TAGS:
+                itemTag = elem.tag
+                break
+        else:
+            header[elem.tag] = elem.text
+    events.close()
+    complete = containerTag is not None or itemTag is not None
+    if rootTag is None:
+        return None
+    try:
+        # same resolution as detectSchema
+        aliases = findProfile(rootTag, containerTag, itemTag)['header']
+    except UnknownSchemaException:
+        return None
+    fields = {}
+    for field, tags in aliases.items():
+        for tag in tags:
+            if tag in header:
+                fields[field] = header[tag]
+                break
+    if len(fields) < len(aliases) and not complete:
+        return None
+    return fields
@@ -1,7 +1,5 @@
 import os
-import gzip
-import xml.etree.ElementTree as ET
-import requests
+import re
 
 from lxml import etree
 from loguru import logger
@@ -9,7 +7,14 @@ from loguru import logger
 from CustomExceptions import WrongChainFileException, NoStoreException, NoSuchStoreException
 
 from Chain import Chain
-
+from Http import getSession, iterContent
+
+# listing pages requested ahead of the one being read
+PREFETCH_PAGES = 3
+LISTING_CHUNK = 16 * 1024
+PRICES_LISTING = "FileObject/UpdateCategory/?catID=2&storeId={storeId}&sort=Time&sortdir=DESC&page={page}"
+STORES_LISTING = "FileObject/UpdateCategory?catID=5"
+fileNameR = re.compile('^(PriceFull|Stores)')
 class Shufersal(Chain):
     '''
     The basic functions each Chain should implement
@@ -21,15 +26,40 @@ class Shufersal(Chain):
         name = 'Shufersal'
         chainId = 7290027600007
         manu = "קטיף."
+        self._startListing()
         super().__init__(db, url, username, password, name, chainId, manu)
 
     def login(self):
-        return requests.Session()
+        return getSession(self.url, self.username)
+
+    def download(self, updateDate=None, onDownloaded=None, beforeSubmit=None):
+        '''
+            Download new data files
+            Listings are read per selected store (all stores if None), pages are prefetched
+            ---------------------
+            Parameters:
+                updateDate - earliest date to download, latest in the db if None
+                onDownloaded - called with the path of each file when its download completes
+                beforeSubmit - called before each file is submitted, see Chain.download
+            Uses:
+            =====================
+            Return:
+                downloaded - files downloaded, in listing order
+            Side effects:
+                downloads files to dirname
+        '''
+        self._startListing(self.selectedStores)
+        try:
+            return super().download(updateDate, onDownloaded, beforeSubmit)
+        finally:
+            self._dropPrefetched()
 
     def download_page(self, page, updateDate=None, firstOfLast=None):
         '''
             Download page with links to FullPrice pages
             impl. per chain subclass
+            Pages are of the current listed store, the next pages are fetched while
+            this one is read, up to the page crossing updateDate
             ---------------------
             Parameters:
                 page - page in paging system
@@ -42,42 +72,34 @@ class Shufersal(Chain):
                 2. should the paging continue
             Side effects:
         '''
-        continuePaging=True
         if updateDate is None:
             updateDate = self._getLatestDate()
-        table = self._getInfoTable(f"FileObject/UpdateCategory/?catID=2&storeId=0&sort=Time&sortdir=DESC&page={page}")
+        if len(self._listingStores) == 0:
+            # no tracked store in the chain
+            return [], False
+        storeId = self._listingStores[0]
+        self._storePage = self._storePage + 1
+        rows = self._prefetchPage(storeId, self._storePage)
         links = []
-        link = None
-        priceFileName = None
-        skip = False
-        for elem in table.iter():
-            if elem.tag == "tr":
-                link = None
-                priceFileName = None
-                skip = False
-            elif skip:
+        cutoff = len(rows) == 0
+        for name, link in rows:
+            if not self.priceR.search(name):
                 continue
-            elif elem.tag == "td":
-                if elem.text is None:
-                    a_elem = elem.find('a')
-                    if a_elem is None:
-                        continue
-                    link = a_elem.get('href')
-                    link = "".join(link.split())
-                else:
-                    if self.priceR.search(elem.text):
-                        fileDate = self._todatetime(self.dateR.search(elem.text).group(1))
-                        if fileDate <= updateDate or firstOfLast == elem.text:
-                            continuePaging = False
-                            self._log(f"Stop paging, reached fileDate: {fileDate}, repeated fetched: {firstOfLast == elem.text}")
-                            break
-                        priceFileName = elem.text
-
-                if priceFileName is not None and link is not None:
-                    links.append({'link': link, 'name': priceFileName})
-                    self._log(f"Found price file {priceFileName}")
-                    skip = True
-        return links, continuePaging
+            fileDate = self._todatetime(self.dateR.search(name).group(1))
+            if fileDate <= updateDate or firstOfLast == name:
+                cutoff = True
+                self._log(f"Stop paging, reached fileDate: {fileDate}, repeated fetched: {firstOfLast == name}")
+                break
+            if not self._isSelected(name):
+                continue
+            links.append({'link': link, 'name': name})
+            self._log(f"Found price file {name}")
+        if cutoff:
+            # no speculative pages past the cutoff, go on to the next store
+            self._dropPrefetched()
+            self._listingStores.pop(0)
+            self._storePage = 0
+        return links, len(self._listingStores) > 0
 
     def getStoreFile(self, updating=True):
         '''
@@ -91,20 +113,13 @@ class Shufersal(Chain):
             Side effects:
                 Download file with stores data
         '''
-        table = self._getInfoTable("FileObject/UpdateCategory?catID=5")
-
         storeFileName = None
         link = None
-        for elem in table.iter():
-            if elem.tag == "td":
-                if elem.text is None:
-                    link = elem.find('a').get('href')
-                    link = "".join(link.split())
-                else:
-                    if self.storeR.search(elem.text):
-                        storeFileName = elem.text
-                if storeFileName is not None and link is not None:
-                    break
+        for name, rowLink in self._listRows(f'{self.url}/{STORES_LISTING}'):
+            if self.storeR.search(name):
+                storeFileName = name
+                link = rowLink
+                break
         if updating and os.path.exists(f"{self.dirname}/{storeFileName}.gz"):
             raise NoSuchStoreException
 
@@ -121,11 +136,9 @@ class Shufersal(Chain):
                 list of Item objects
         '''
         self._log(f"Obtaining stores from {fn}")
-        with gzip.open(fn, 'rt') as f:
-            data = f.read()
-            context = ET.fromstring(data)
+        context = self.backend.parse(fn)
 
-        chainId = int(context.find('.//CHAINID').text)
+        chainId = int(self.backend.find(context, './/CHAINID').text)
         if self.chainId is not None and chainId != self.chainId:
             # chainId in file should be like setup
             logger.error(f"Chain {self.chainId}: file with wrong chain Id {chainId} supplied {fn}")
@@ -138,7 +151,7 @@ class Shufersal(Chain):
         subchains = self._getSubchains(self.chainId)
         stores = self._getStores(self.chainId)
 
-        storesElem = context.find('.//STORES')
+        storesElem = self.backend.find(context, './/STORES')
         storesIns = {}
         storeLinks = {}
         for store in storesElem:
@@ -165,23 +178,69 @@ class Shufersal(Chain):
         self._insertStores(storesIns, storeLinks)
 
      # ========== PRIVATE ==========
-    def _getInfoTable(self, local_path):
+    def _startListing(self, stores=None):
+        # stores left to list (0 lists all stores), page of the current store and prefetched pages
+        self._listingStores = [0] if stores is None else sorted(stores)
+        self._storePage = 0
+        self._prefetched = {}
+
+    def _prefetchPage(self, storeId, page):
         '''
-            In Shufersal interface get information table
+            Rows of a listing page, requesting the next PREFETCH_PAGES pages ahead
             ---------------------
             Parameters:
-                local_path - xml path to table
+                storeId - store of the listing, 0 for all
+                page - page number
             Uses:
             =====================
             Return:
-                xml tree of the table
+                list of (file name, link)
+        '''
+        for ahead in range(page, page + PREFETCH_PAGES):
+            if (storeId, ahead) not in self._prefetched:
+                url = f'{self.url}/{PRICES_LISTING.format(storeId=storeId, page=ahead)}'
+                self._prefetched[(storeId, ahead)] = self.downloader.submit(url, self._listRows, url)
+        return self._prefetched.pop((storeId, page)).result()
+
+    def _dropPrefetched(self):
+        for future in self._prefetched.values():
+            future.cancel()
+        self._prefetched = {}
+
+    def _listRows(self, url):
+        '''
+            Rows of a Shufersal listing table, parsed while streamed
+            ---------------------
+            Parameters:
+                url - listing page url
+            Uses:
+            =====================
+            Return:
+                list of (file name, link) in table order
             Side effects:
         '''
-
-        url =f'{self.url}/{local_path}'
         self._log(f"searching for table {url}")
-        r = requests.get(url)
-        res = r.text
-        html = etree.HTML(res)
-        table = html.find("body/div/table/tbody")
-        return(table)
+        parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding='utf-8')
+        rows = []
+        with self._request('GET', url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in iterContent(r, LISTING_CHUNK, client=self):
+                parser.feed(chunk)
+                self._readRows(parser, rows)
+        parser.close()
+        self._readRows(parser, rows)
+        return rows
+
+    def _readRows(self, parser, rows):
+        for _, tr in parser.read_events():
+            name = None
+            link = None
+            for td in tr.iter('td'):
+                a = td.find('a')
+                if a is not None and link is None:
+                    link = "".join(a.get('href', '').split())
+                elif td.text is not None and fileNameR.search(td.text.strip()):
+                    name = td.text.strip()
+            if name is not None and link is not None:
+                rows.append((name, link))
+            tr.clear()
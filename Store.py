@@ -1,51 +1,50 @@
 import re
-import gzip
-from zipfile import ZipFile
 import datetime
-import xml.etree.ElementTree as ET
 
 from loguru import logger
 
-from CustomExceptions import WrongChainFileException, WrongStoreFileException, NoStoreException
+from CustomExceptions import WrongChainFileException, WrongStoreFileException, NoStoreException, UnknownSchemaException
 from Item import Item
+from XmlBackend import getBackend
+from Schema import detectSchema
+from Profiler import profiler
+from ItemMatcher import MATCH_MANU, MATCH_CODE, MATCH_CATEGORY
 
 dateR = re.compile('-(\d{12})')
 class Store:
-    def __init__(self, db, fn, targetManu, itemCodes, codeCategoryR, chainId):
+    def __init__(self, db, fn, matcher, chainId, backend=None, resolve=True):
         '''
         Initialize a store inside a chain
         ---------------------
         Parameters:
             db -  handle to DB
             fn - filename
-            targetManu - manufacturer to target it's products
-            itemCodes - specific item codes to search for
+            matcher - ItemMatcher of the chain's wanted items
             chainId - chain external ID
-            chain - chain internal ID
+            backend - xml parsing backend, see XmlBackend
+            resolve - look up the store in the db, False for parsing only (no db access)
         =====================
         Return:
             Store object
         '''
         self.db = db
         self.fn = fn
-        self.manu = targetManu
-        self.itemCodes = itemCodes
-        self.codeCategoryR = codeCategoryR
+        self.matcher = matcher
         self.chainId = chainId
+        self.backend = getBackend() if backend is None else backend
         logger.info(f"Start store for chain {self.chainId} using file {self.fn}")
         date = dateR.search(fn).group(1)
         self.datetime = datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]), int(date[8:10]), int(date[10:12]))
+        self.strdate = self.datetime.strftime('%Y-%m-%d %H:%M')
 
 
-        with gzip.open(fn, 'rt') as f:
-            data = f.read()
-            self.context = ET.fromstring(data)
-
-        try:
-            self._storeDetails(self.context)
-        except AttributeError:
-            logger.info(f"File {fn} not an xml Store file")
-            raise WrongStoreFileException
+        with profiler.profile('Store', self.chainId, self.fn):
+            try:
+                self.schema, header = detectSchema(self.fn, self.backend)
+                self._storeDetails(header, resolve)
+            except (KeyError, UnknownSchemaException, self.backend.ParseError):
+                logger.info(f"File {fn} not an xml Store file")
+                raise WrongStoreFileException
         self._log(f"Inited")
 
 
@@ -70,7 +69,9 @@ class Store:
 
     def obtainItems(self):
         '''
-            Obtain wanted items from XML file by parsing the whole file and extracting the items
+            Obtain wanted items from XML file by streaming over the items once
+            Each item is checked against the manufacturer, item codes and code category
+            filters and cleared from memory right after
             ---------------------
             Parameters:
             =====================
@@ -78,46 +79,27 @@ class Store:
                 list of Item objects
             Side effects:
         '''
-        manuItems = []
-        codeItems = []
-        lenItems = []
-        catItems = []
-        # Check if MatrixChain
-        if self.context.tag == 'Prices':
-            self._log('Handling MatrixChain type')
-            manuSearch = "Products/Product/ManufactureName"
-            itemSearch = "Products/Product"
-        else:
-            manuSearch = "Items/Item/ManufacturerName"
-            itemSearch = "Items/Item"
-        if self.manu is not None:
-            self._log(f"Obtaining items from manufactuer {self.manu}")
-            manuSearchPath = f'{manuSearch}[.="{self.manu}"]...'
-            manuXmlItems = self.context.findall(manuSearchPath)
-            manuItems = [Item(self.chainId, self.store, self.datetime, xmlItem) for xmlItem in manuXmlItems]
-            self._log(f"Found {len(manuItems)} manufacturer items")
-
-        if self.itemCodes is not None:
-            for code in self.itemCodes:
-                self._log(f"Obtaining item with code {code}")
-                _items = self.context.findall(f'{itemSearch}/ItemCode[.="{code}"]...')
-                if len(_items) > 0:
-                    xmlItem = _items[0]
-                    codeItems.append(Item(self.chainId, self.store, self.datetime, xmlItem))
-            self._log(f"Found {len(codeItems)} items with code {code}")
-
-        if self.codeCategoryR is not None:
-            self._log(f"Obtaining item matching code category {self.codeCategoryR}")
-            # Check if MatrixChain
-            _catItems = self.context.findall(itemSearch)
-            for _item in _catItems:
-                code = _item.find('ItemCode').text
-                if self.codeCategoryR.search(code) is not None:
-                    catItems.append(Item(self.chainId, self.store, self.datetime, _item))
-            self._log(f"Found {len(catItems)} code category items")
-
-
-        items = manuItems + codeItems + lenItems + catItems
+        matched = {MATCH_MANU: [], MATCH_CODE: [], MATCH_CATEGORY: []}
+        seenCodes = set()
+        matchManu = self.matcher.manu is not None
+        self._log(f"Obtaining items with {self.matcher}")
+
+        with profiler.profile('obtainItems', self.chainId, self.fn):
+            codeTag = self.schema.codeTag
+            manuTag = self.schema.manuTag
+            for elem in self.backend.iterElements(self.fn, (self.schema.itemTag,), (self.schema.containerTag,)):
+                code = elem.findtext(codeTag)
+                rule = self.matcher.match(code, elem.findtext(manuTag) if matchManu else None)
+                if rule == MATCH_CODE:
+                    # only the first item with a given code is used
+                    if code in seenCodes:
+                        rule = None
+                    seenCodes.add(code)
+                if rule is not None:
+                    matched[rule].append(Item(elem, self.schema.itemMap))
+
+        self._log(f"Found {len(matched[MATCH_MANU])} manufacturer items, {len(matched[MATCH_CODE])} code items, {len(matched[MATCH_CATEGORY])} code category items")
+        items = matched[MATCH_MANU] + matched[MATCH_CODE] + matched[MATCH_CATEGORY]
         return items
 
     def getPrices(self, items):
@@ -150,7 +132,7 @@ class Store:
             self._insertChainItems(missing_items)
             ids_codes = self._getItemIds(itemCodes)
         self._log(f"got {len(ids_codes)} id codes")
-        prices = [itemsObj[code].getPriceItem(iid) for iid, code in ids_codes]
+        prices = [itemsObj[code].getPriceItem(self.strdate, self.store, iid) for iid, code in ids_codes]
         return(prices)
 
     def insertPrices(self, prices):
@@ -181,28 +163,26 @@ class Store:
         self._log(f"Logged {insPrices} item prices")
 
     # ===========PRIVATE=========
-    def _storeDetails(self, context):
+    def _storeDetails(self, header, resolve=True):
         '''
             Get store details from a store prices file
             ---------------------
             Parameters:
-                context - xml object
+                header - dict of header values, see Schema.detectSchema
+                resolve - look up the store internal id
             =====================
             Return:
                 Nothing
             Side effects:
                 sets the store values in the object
         '''
-        try:
-            fileChain = int(context.find('ChainID').text)
-            self.subChain = int(context.find('SubChainID').text)
-            self.storeId = int(context.find('StoreID').text)
-        except AttributeError:
-            fileChain = int(context.find('ChainId').text)
-            self.subChain = int(context.find('SubChainId').text)
-            self.storeId = int(context.find('StoreId').text)
+        fileChain = int(header['ChainId'])
+        self.subChain = int(header['SubChainId'])
+        self.storeId = int(header['StoreId'])
         if fileChain != self.chainId:
             raise WrongChainFileException
+        if not resolve:
+            return
         try:
             self.store = self.getStore()
         except TypeError:
@@ -238,7 +218,7 @@ class Store:
             Side effects:
                 update db
         '''
-        itemsList = [item.getChainItem() for item in items]
+        itemsList = [item.getChainItem(self.chainId) for item in items]
         con = self.db.getConn()
         cur = con.cursor()
         query = '''
@@ -252,3 +232,19 @@ class Store:
 
     def _log(self, mes):
         logger.info(f"Store {self.storeId}@{self.chainId}: {mes}")
+
+def parseStoreFile(fn, matcher, chainId, backendName=None):
+    '''
+        Parse a prices file without db access, process pool worker of Chain.scanStores
+        ---------------------
+        Parameters:
+            fn - filename
+            matcher - ItemMatcher of the chain's wanted items
+            chainId - chain external ID
+            backendName - xml parsing backend name
+        =====================
+        Return:
+            list of matched Item objects
+    '''
+    store = Store(None, fn, matcher, chainId, getBackend(backendName), resolve=False)
+    return store.obtainItems()
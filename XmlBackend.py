@@ -0,0 +1,258 @@
+import os
+import gzip
+import codecs
+import xml.etree.ElementTree as ET
+
+from loguru import logger
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# backend used when a chain doesn't pick one, PARSER_BACKEND env var overrides
+DEFAULT_BACKEND = os.environ.get('PARSER_BACKEND', 'lxml')
+# decompressed bytes fed to the parser at a time, peak memory per file is about
+# a chunk plus the item being parsed
+CHUNK_SIZE = 64 * 1024
+# enough to hold any BOM
+SNIFF_SIZE = 4
+
+def sniffEncoding(head):
+    '''
+        Find the encoding of an xml byte stream from its BOM or first bytes
+        Published prices files may be UTF-16 while the xml header claims UTF-8
+        ---------------------
+        Parameters:
+            head - first bytes of the stream
+        =====================
+        Return:
+            encoding overriding the declared one, None to use the declared encoding
+    '''
+    if head.startswith(codecs.BOM_UTF8):
+        return 'UTF-8'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'UTF-16'
+    if head.startswith(b'<\x00'):
+        return 'UTF-16LE'
+    if head.startswith(b'\x00<'):
+        return 'UTF-16BE'
+    return None
+
+def sniffFile(f):
+    '''
+        Sniff the encoding of an open gzip file without consuming it
+    '''
+    return sniffEncoding(f.peek(SNIFF_SIZE)[:SNIFF_SIZE])
+
+def readChunks(f, size=CHUNK_SIZE):
+    '''
+        Read a binary file in chunks into one reusable buffer
+        ---------------------
+        Parameters:
+            f - binary file (gzip.GzipFile)
+            size - buffer size
+        =====================
+        Return:
+            generator of memoryview chunks, a chunk is only valid until the next one is read
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    n = f.readinto(buf)
+    while n:
+        yield view[:n]
+        n = f.readinto(buf)
+
+def feedEvents(parser, f, copy=False):
+    '''
+        Feed a pull parser with the file chunks
+        ---------------------
+        Parameters:
+            parser - XMLPullParser (stdlib or lxml)
+            f - binary file
+            copy - feed bytes copies of the chunks, for parsers not taking buffers
+        =====================
+        Return:
+            generator of the parser events
+    '''
+    for chunk in readChunks(f):
+        parser.feed(chunk.tobytes() if copy else chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def feedHead(parser, f, size):
+    '''
+        Feed a pull parser with only the start of the file, the parser is left open
+        ---------------------
+        Parameters:
+            parser - XMLPullParser (stdlib or lxml)
+            f - binary file
+            size - decompressed bytes to feed
+        =====================
+        Return:
+            generator of the parser events
+    '''
+    parser.feed(f.read(size))
+    yield from parser.read_events()
+
+def feedTree(parser, f, copy=False):
+    '''
+        Feed a tree parser with the file chunks
+        ---------------------
+        Parameters:
+            parser - XMLParser (stdlib or lxml)
+            f - binary file
+            copy - feed bytes copies of the chunks, for parsers not taking buffers
+        =====================
+        Return:
+            root element
+    '''
+    for chunk in readChunks(f):
+        parser.feed(chunk.tobytes() if copy else chunk)
+    return parser.close()
+
+class StdlibBackend:
+    '''
+    xml.etree.ElementTree parsing backend
+    '''
+    name = 'stdlib'
+    ParseError = ET.ParseError
+
+    def parse(self, fn, encoding=None):
+        '''
+            Parse a whole gzip xml file
+            ---------------------
+            Parameters:
+                fn - file name
+                encoding - overrides the encoding declared in the file, sniffed if None
+            =====================
+            Return:
+                root element
+        '''
+        with gzip.open(fn, 'rb') as f:
+            if encoding is None:
+                encoding = sniffFile(f)
+            return feedTree(ET.XMLParser(encoding=encoding), f)
+
+    def iterEvents(self, fn, head=None):
+        '''
+            Stream start and end events of a gzip xml file, used to read its head
+            ---------------------
+            Parameters:
+                fn - file name
+                head - decompressed bytes to parse, None for the whole file
+            =====================
+            Return:
+                generator of (event, element)
+        '''
+        with gzip.open(fn, 'rb') as f:
+            parser = self._pullParser(("start", "end"), sniffFile(f))
+            if head is not None:
+                yield from feedHead(parser, f, head)
+                return
+            yield from feedEvents(parser, f)
+
+    def iterElements(self, fn, tags, containerTags):
+        '''
+            Stream elements of a gzip xml file, each one is cleared after it is consumed
+            ---------------------
+            Parameters:
+                fn - file name
+                tags - tags of elements to yield
+                containerTags - tags of the elements holding them, cleared as parsing goes
+            =====================
+            Return:
+                generator of elements
+        '''
+        with gzip.open(fn, 'rb') as f:
+            container = None
+            for event, elem in feedEvents(self._pullParser(("start", "end"), sniffFile(f)), f):
+                if event == "start":
+                    if elem.tag in containerTags:
+                        container = elem
+                    continue
+                if elem.tag not in tags:
+                    continue
+                yield elem
+                if container is not None:
+                    container.clear()
+                else:
+                    elem.clear()
+
+    def find(self, elem, path):
+        return elem.find(path)
+
+    def _pullParser(self, events, encoding):
+        if encoding is None:
+            return ET.XMLPullParser(events=events)
+        # XMLPullParser can't override the encoding by itself
+        return ET.XMLPullParser(events=events, _parser=ET.XMLParser(target=ET.TreeBuilder(), encoding=encoding))
+
+class LxmlBackend:
+    '''
+    lxml (libxml2) parsing backend
+    lxml parsers only take bytes, so each chunk is copied once before feeding
+    '''
+    name = 'lxml'
+    ParseError = etree.XMLSyntaxError if etree is not None else None
+
+    def __init__(self):
+        self._xpaths = {}
+
+    def parse(self, fn, encoding=None):
+        with gzip.open(fn, 'rb') as f:
+            if encoding is None:
+                encoding = sniffFile(f)
+            return feedTree(etree.XMLParser(encoding=encoding, huge_tree=True), f, copy=True)
+
+    def iterEvents(self, fn, head=None):
+        with gzip.open(fn, 'rb') as f:
+            parser = etree.XMLPullParser(events=("start", "end"), encoding=sniffFile(f), huge_tree=True)
+            if head is not None:
+                yield from feedHead(parser, f, head)
+                return
+            yield from feedEvents(parser, f, copy=True)
+
+    def iterElements(self, fn, tags, containerTags):
+        with gzip.open(fn, 'rb') as f:
+            parser = etree.XMLPullParser(events=("end",), tag=tags, encoding=sniffFile(f), huge_tree=True)
+            for event, elem in feedEvents(parser, f, copy=True):
+                yield elem
+                elem.clear(keep_tail=True)
+                # drop the cleared siblings left in the parent
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    def find(self, elem, path):
+        '''
+            find using a compiled XPath, paths are ElementPath compatible (.//Tag, Tag)
+        '''
+        xpath = self._xpaths.get(path)
+        if xpath is None:
+            xpath = etree.XPath(path)
+            self._xpaths[path] = xpath
+        found = xpath(elem)
+        return found[0] if len(found) > 0 else None
+
+BACKENDS = {
+        'stdlib': StdlibBackend,
+        'lxml': LxmlBackend,
+}
+
+def getBackend(name=None):
+    '''
+        Get a parsing backend by name
+        ---------------------
+        Parameters:
+            name - backend name, DEFAULT_BACKEND if None
+        =====================
+        Return:
+            backend object
+    '''
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name == 'lxml' and etree is None:
+        logger.warning("lxml is not installed, using the stdlib parsing backend")
+        name = 'stdlib'
+    return BACKENDS[name]()
@@ -10,11 +10,10 @@
 # http://matrixcatalog.co.il/NBCompetitionRegulations.aspx # victory, no passcode
 # http://publishprice.ybitan.co.il/ # yenot bitan, no passcode
 
-import tracemalloc
-import timeit
 import time
 import datetime
 
+import requests
 from loguru import logger
 
 from Shufersal import Shufersal
@@ -23,68 +22,13 @@ from BinaChain import KingStore, ShukHayir, ShefaBirkat, ZolVeBegadol
 from CerberusChain import RamiLevy, Yohananof, Dabach, DorAlon, HaziHinam, Keshet, OsherAd, StopMarket, TivTaam, Yohananof
 from MatrixChain import Victory, HaShuk
 from DBConn import DB
+from Profiler import profiler
+from Scheduler import scheduler
+from CustomExceptions import CircuitOpenException, InvalidDownloadException
 
 TESTING = False
-
-def SAX_obtain(fn, targetManu):
-    '''
-        Obtain wanted items from XML file by picking the items while parsing
-        ---------------------
-        Parameters:
-            fn - file name
-            targetManu - which manufacturer's items to get
-        =====================
-        Return:
-            list of Item objects
-        Side effects:
-    '''
-    context = ET.iterparse(fn, events=("start", "end"))
-    _, root = next(context)
-    items = None
-    currItem = None
-    manuIdentified = False
-    relItems = []
-
-    for event, elem in context:
-        if items is None:
-            if event == "start" and elem.tag == "Items":
-                items = elem
-                root.clear()
-        else:
-            if currItem is None:
-                if event == "start" and elem.tag == "Item":
-                    currItem = elem
-            elif not manuIdentified:
-                if event == "end" and \
-                elem.tag == "ManufacturerName" and \
-                elem.text == targetManu:
-                        manuIdentified = True
-            else:
-                if event == "end" and elem.tag == "Item":
-                    relItems.append(Item(currItem))
-                    currItem = None
-                    manuIdentified = False
-                    items.clear()
-    return(relItems)
-
-def timing_tests(fn, targetManu, n=10):
-    '''
-        Time different filterting methods
-        ---------------------
-        Parameters:
-            fn - file name
-            targetManu - which manufacturer's items to get
-        =====================
-        Return:
-            list of Item objects
-        Side effects:
-    '''
-    res1 = SAX_obtain(fn, targetManu)
-    res2 = obtain_items(fn, targetManu)
-    print(len(res1), len(res2))
-    t1 = timeit.timeit(lambda: SAX_obtain(fn, targetManu), number=n)
-    t2 = timeit.timeit(lambda: obtain_items(fn, targetManu), number=n)
-    print(t1, t2)
+# record per file memory use, see Profiler (also MEMORY_PROFILE env var)
+PROFILE_MEMORY = False
 
 @logger.catch
 def main(targetTime=0):
@@ -102,7 +46,8 @@ def main(targetTime=0):
         nextDay = start + datetime.timedelta(1)
         targetTime = datetime.datetime(nextDay.year, nextDay.month, nextDay.day, 4)
         for chain in chains:
-            chain.scanStores()
+            scanChain(chain)
+        scheduler.report()
 
 @logger.catch
 # patch to re-read YBitan data
@@ -112,10 +57,20 @@ def patch_chains():
     chains = init_chains(dbc)
     logger.info(f"Patching chains")
     for chain in chains:
-        chain.scanStores(newDay=False)
+        scanChain(chain, newDay=False)
         logger.info(f"Finished {chain.name} patching")
+    scheduler.report()
     main(datetime.datetime(2023, 7, 11, 4))
 
+def scanChain(chain, newDay=True):
+    '''
+        Scan a chain, a platform that is down doesn't stop the other chains
+    '''
+    try:
+        chain.scanStores(newDay=newDay)
+    except (CircuitOpenException, InvalidDownloadException, requests.exceptions.RequestException) as e:
+        logger.warning(f"Skipping {chain.name} this round: {type(e).__name__} {e}")
+
 def init_chains(db):
     chains = []
 # from MegaChain import YBitan, Mega, MegaMarket
@@ -146,6 +101,8 @@ if __name__ == '__main__':
     logger.add("./logs/scanning_{time}.log", rotation="03:00", compression="zip", enqueue=True, filter=lambda record: record["level"].no < 30, format="{time:YYYY-MM-DD HH:mm:ss.SSS}| {message}", level="INFO")
     logger.add("./logs/crash.log", backtrace=True, diagnose=True, level="WARNING")
     logger.info("Starting")
+    if PROFILE_MEMORY:
+        profiler.enable()
     if TESTING:
         testing()
     else: